@@ -0,0 +1,416 @@
+"""
+Аналитика квестов: журнал событий игроков и сводка для /stats.
+
+Пересобрать сводку по журналам (потоково, без загрузки в память):
+  python analytics.py rebuild [analytics.ndjson ...]
+Показать сводку по сохранённым снимкам:
+  python analytics.py report [analytics.ndjson]
+"""
+import argparse
+import asyncio
+import collections
+import glob
+import json
+import logging
+import os
+import time
+
+from metrics import Histogram
+
+ANALYTICS_LOG = "analytics.ndjson"
+MAX_LOG_BYTES = 16 * 2 ** 20  # после этого размера журнал уходит в архив и начинается новый
+SNAPSHOT_INTERVAL = 30  # секунды между сохранениями сводки
+# Границы корзин времени прохождения этапа, секунды
+STAGE_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 43200, 86400)
+
+logger = logging.getLogger(__name__)
+
+
+def worker_log_path(path, worker=None):
+    """Журнал воркера: analytics.ndjson -> analytics-1.ndjson."""
+    if worker is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{worker}{ext}"
+
+
+def snapshot_path(path):
+    return path + ".stats.json"
+
+
+def _archived(path):
+    """Номера архивных частей журнала (path.0, path.1, ...) по возрастанию."""
+    indexes = []
+    for name in glob.glob(glob.escape(path) + ".*"):
+        suffix = name[len(path) + 1:]
+        if suffix.isdigit():
+            indexes.append(int(suffix))
+    return sorted(indexes)
+
+
+def _segment(path, index, current):
+    return path if index == current else f"{path}.{index}"
+
+
+def read_events(path, segment=0, offset=0):
+    """
+    Читает события журнала по порядку, начиная с позиции (часть, смещение).
+
+    Отдаёт (событие, часть, смещение после события). Повреждённые строки
+    (например, недописанная при падении) пропускаются.
+    """
+    archived = _archived(path)
+    current = archived[-1] + 1 if archived else 0
+    for index in archived + [current]:
+        if index < segment:
+            continue
+        try:
+            file = open(_segment(path, index, current), "rb")
+        except FileNotFoundError:
+            continue
+        with file:
+            if index == segment:
+                file.seek(offset)
+            position = file.tell()
+            for line in file:
+                position += len(line)
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logger.warning("Повреждённая строка в %s на смещении %d", path, position - len(line))
+                    continue
+                yield event, index, position
+
+
+class StepStats:
+    __slots__ = ("finished", "correct", "wrong", "photos", "attempts", "durations")
+
+    def __init__(self):
+        self.finished = 0
+        self.correct = 0
+        self.wrong = 0
+        self.photos = 0
+        self.attempts = collections.Counter()  # "1", "2", ... или "failed" -> игроков
+        self.durations = Histogram(STAGE_BUCKETS)
+
+
+class QuestStats:
+    __slots__ = ("started", "completed", "steps")
+
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.steps = {}
+
+    def step(self, step_id):
+        stats = self.steps.get(step_id)
+        if stats is None:
+            stats = self.steps[step_id] = StepStats()
+        return stats
+
+
+class Stats:
+    """
+    Сводка по событиям: воронка, попытки на вопросах и время этапов.
+
+    Каждое событие меняет несколько счётчиков и одну гистограмму,
+    поэтому сводка всегда актуальна и /stats не перебирает историю.
+    """
+
+    def __init__(self):
+        self.quests = {}
+
+    def quest(self, quest_id):
+        stats = self.quests.get(quest_id)
+        if stats is None:
+            stats = self.quests[quest_id] = QuestStats()
+        return stats
+
+    def apply(self, event):
+        quest = self.quest(event["q"])
+        kind = event["ev"]
+        if kind == "start":
+            quest.started += 1
+        elif kind == "done":
+            quest.completed += 1
+        elif kind in ("answer", "photo", "stage"):
+            step = quest.step(event["s"])
+            if kind == "answer":
+                if event["ok"]:
+                    step.correct += 1
+                else:
+                    step.wrong += 1
+            elif kind == "photo":
+                step.photos += event["n"]
+            else:
+                step.finished += 1
+                if "n" in event:
+                    step.attempts[str(event["n"]) if event.get("ok") else "failed"] += 1
+                if event.get("dur") is not None:
+                    step.durations.observe(event["dur"])
+
+    def merge(self, other):
+        for quest_id, other_quest in other.quests.items():
+            quest = self.quest(quest_id)
+            quest.started += other_quest.started
+            quest.completed += other_quest.completed
+            for step_id, other_step in other_quest.steps.items():
+                step = quest.step(step_id)
+                step.finished += other_step.finished
+                step.correct += other_step.correct
+                step.wrong += other_step.wrong
+                step.photos += other_step.photos
+                step.attempts.update(other_step.attempts)
+                durations, other_durations = step.durations, other_step.durations
+                durations.counts = [a + b for a, b in zip(durations.counts, other_durations.counts)]
+                durations.count += other_durations.count
+                durations.sum += other_durations.sum
+        return self
+
+    def to_dict(self):
+        return {
+            quest_id: {
+                "started": quest.started,
+                "completed": quest.completed,
+                "steps": {
+                    step_id: {
+                        "finished": step.finished,
+                        "correct": step.correct,
+                        "wrong": step.wrong,
+                        "photos": step.photos,
+                        "attempts": dict(step.attempts),
+                        "durations": step.durations.counts,
+                        "duration_sum": step.durations.sum,
+                    }
+                    for step_id, step in quest.steps.items()
+                },
+            }
+            for quest_id, quest in self.quests.items()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for quest_id, quest_data in data.items():
+            quest = stats.quest(quest_id)
+            quest.started = quest_data["started"]
+            quest.completed = quest_data["completed"]
+            for step_id, step_data in quest_data["steps"].items():
+                step = quest.step(step_id)
+                step.finished = step_data["finished"]
+                step.correct = step_data["correct"]
+                step.wrong = step_data["wrong"]
+                step.photos = step_data["photos"]
+                step.attempts.update(step_data["attempts"])
+                if len(step_data["durations"]) == len(step.durations.counts):
+                    step.durations.counts = list(step_data["durations"])
+                    step.durations.count = sum(step.durations.counts)
+                    step.durations.sum = step_data["duration_sum"]
+        return stats
+
+
+def load_snapshot(path):
+    """(сводка, часть, смещение) из снимка или пустая сводка с начала журнала."""
+    try:
+        with open(snapshot_path(path), "r") as file:
+            snapshot = json.load(file)
+        return Stats.from_dict(snapshot["stats"]), snapshot["segment"], snapshot["offset"]
+    except FileNotFoundError:
+        return Stats(), 0, 0
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Снимок сводки %s повреждён, пересобираем по журналу: %s", path, e)
+        return Stats(), 0, 0
+
+
+def save_snapshot(path, stats, segment, offset):
+    tmp_path = snapshot_path(path) + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"segment": segment, "offset": offset, "stats": stats.to_dict()}, file)
+    os.replace(tmp_path, snapshot_path(path))
+
+
+def replay(path):
+    """Сводка журнала: снимок плюс события после него. Возвращает (сводка, часть, смещение)."""
+    stats, segment, offset = load_snapshot(path)
+    replayed = 0
+    for event, segment, offset in read_events(path, segment, offset):
+        stats.apply(event)
+        replayed += 1
+    if replayed:
+        logger.info("Сводка %s догнала журнал: %d событий", path, replayed)
+    return stats, segment, offset
+
+
+class Analytics:
+    """
+    Журнал событий квеста (NDJSON, только дозапись) и сводка по нему.
+
+    Событие — одна короткая строка JSON: время, тип, квест, шаг, игрок
+    и пара полей. Когда журнал вырастает до max_bytes, он переименовывается
+    в analytics.ndjson.N и начинается новый; архивные части не меняются.
+
+    Сводка обновляется вместе с записью каждого события и раз в
+    SNAPSHOT_INTERVAL секунд сохраняется рядом с журналом вместе
+    с позицией, до которой она посчитана. При запуске читается снимок
+    и дочитывается только хвост журнала после него.
+
+    В многопроцессном режиме у каждого воркера свой журнал (worker_log_path);
+    combined_stats() добавляет к своей сводке сводки остальных: снимок
+    читается один раз, дальше при каждом вызове дочитывается только
+    хвост журнала с прошлого раза.
+    """
+
+    def __init__(self, path=ANALYTICS_LOG, worker=None, max_bytes=MAX_LOG_BYTES):
+        self.base_path = path
+        self.path = worker_log_path(path, worker)
+        self.max_bytes = max_bytes
+        self.stats, self._segment, self._offset = replay(self.path)
+        self._saved = (self._segment, self._offset)
+        self._others = {}  # журнал другого воркера -> [сводка, часть, смещение]
+        self._open()
+
+    def _open(self):
+        archived = _archived(self.path)
+        current = archived[-1] + 1 if archived else 0
+        if current != self._segment:
+            # Журнал повернули, а снимок не успели сохранить: всё уже прочитано
+            self._segment, self._offset = current, 0
+        self._file = open(self.path, "ab")
+        size = self._file.tell()
+        if size != self._offset:
+            # Недописанная при падении строка склеилась бы со следующей
+            self._file.truncate(self._offset)
+            self._file.seek(self._offset)
+
+    def record(self, event, quest_id, user_id, step_id=None, **fields):
+        data = {"ts": round(time.time(), 3), "ev": event, "q": quest_id, "u": user_id}
+        if step_id is not None:
+            data["s"] = step_id
+        data.update(fields)
+        line = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+        try:
+            self._file.write(line)
+            self._file.flush()
+        except OSError as e:
+            logger.error("Не удалось записать событие в %s: %s", self.path, e)
+            return
+        self._offset += len(line)
+        self.stats.apply(data)
+        if self._offset >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        os.replace(self.path, f"{self.path}.{self._segment}")
+        self._segment += 1
+        self._offset = 0
+        self._file = open(self.path, "ab")
+        self.save()
+
+    def save(self):
+        """Сохраняет снимок сводки, если с прошлого раза были события."""
+        position = (self._segment, self._offset)
+        if position == self._saved:
+            return
+        try:
+            save_snapshot(self.path, self.stats, *position)
+        except OSError as e:
+            logger.error("Не удалось сохранить сводку %s: %s", self.path, e)
+            return
+        self._saved = position
+
+    async def run(self, interval=SNAPSHOT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.save()
+
+    def _other_stats(self, path):
+        """Сводка журнала другого воркера, догнанная до его текущего конца."""
+        other = self._others.get(path)
+        if other is None:
+            other = self._others[path] = list(load_snapshot(path))
+        stats, segment, offset = other
+        for event, segment, offset in read_events(path, segment, offset):
+            stats.apply(event)
+        other[1:] = segment, offset
+        return stats
+
+    def combined_stats(self):
+        """Своя сводка плюс сводки журналов других воркеров на текущий момент."""
+        stats = Stats().merge(self.stats)
+        root, ext = os.path.splitext(self.base_path)
+        paths = {self.base_path} | set(glob.glob(glob.escape(root) + "-*" + glob.escape(ext)))
+        for path in sorted(paths - {self.path}):
+            if os.path.exists(path) or os.path.exists(snapshot_path(path)):
+                stats.merge(self._other_stats(path))
+        return stats
+
+    def close(self):
+        self.save()
+        self._file.close()
+
+
+def _duration(seconds):
+    if seconds < 90:
+        return f"{seconds:.0f} с"
+    if seconds < 5400:
+        return f"{seconds / 60:.1f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+def format_stats(stats, quests=()):
+    """Текст для /stats: воронка по шагам квеста, попытки и время этапов."""
+    titles = {quest.id: (quest.title, [step.id for step in quest.steps]) for quest in quests}
+    lines = []
+    for quest_id, quest in stats.quests.items():
+        title, step_ids = titles.get(quest_id, (quest_id, list(quest.steps)))
+        step_ids += [step_id for step_id in quest.steps if step_id not in step_ids]
+        lines += ["", f"📊 {title}: начали {quest.started}, прошли {quest.completed}"]
+        for number, step_id in enumerate(step_ids, 1):
+            step = quest.steps.get(step_id)
+            if step is None:
+                lines.append(f"{number}. {step_id}: 0")
+                continue
+            parts = [f"{number}. {step_id}: {step.finished}"]
+            if step.attempts:
+                solved = sorted((int(key), count) for key, count in step.attempts.items() if key != "failed")
+                attempts = [f"{key}:{count}" for key, count in solved]
+                if step.attempts["failed"]:
+                    attempts.append(f"не решили:{step.attempts['failed']}")
+                parts.append("попытки " + " ".join(attempts))
+            if step.photos:
+                parts.append(f"фото {step.photos}")
+            if step.durations.count:
+                parts.append(
+                    f"время p50 {_duration(step.durations.quantile(0.5))}, p90 {_duration(step.durations.quantile(0.9))}"
+                )
+            lines.append(" | ".join(parts))
+    return "\n".join(lines).strip() or "Пока нет событий."
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("rebuild", "report"))
+    parser.add_argument("paths", nargs="*", default=[ANALYTICS_LOG], help="журналы событий")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    total = Stats()
+    for path in args.paths:
+        if args.command == "rebuild":
+            stats, segment, offset, events = Stats(), 0, 0, 0
+            for event, segment, offset in read_events(path):
+                stats.apply(event)
+                events += 1
+            save_snapshot(path, stats, segment, offset)
+            logger.info("%s: %d событий, снимок %s", path, events, snapshot_path(path))
+        else:
+            stats = load_snapshot(path)[0]
+        total.merge(stats)
+    print(format_stats(total))
+
+
+if __name__ == "__main__":
+    main()
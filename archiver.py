@@ -0,0 +1,200 @@
+"""
+Архив фотографий, присланных на фото-задания.
+
+Найти фото игрока или задания по индексу:
+  python archiver.py [--user ID] [--quest ID] [--task ID] [--dir photos]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiohttp import ClientError
+
+from metrics import registry
+
+ARCHIVE_DIR = "photos"
+ARCHIVE_WORKERS = 4  # одновременных скачиваний
+ARCHIVE_QUEUE_SIZE = 10000  # фото в очереди; дальше новые не архивируются
+DOWNLOAD_ATTEMPTS = 3
+INDEX_FILE = "index.ndjson"
+
+logger = logging.getLogger(__name__)
+registry.describe("archive_download_seconds", "Время скачивания одной фотографии в архив")
+registry.describe("archive_downloaded_total", "Фотографии, скачанные в архив")
+registry.describe("archive_bytes_total", "Байты, скачанные в архив")
+registry.describe("archive_deduplicated_total", "Фотографии, которые уже были в архиве (повторная отправка)")
+registry.describe("archive_dropped_total", "Фотографии, не попавшие в архив из-за переполненной очереди")
+registry.describe("archive_errors_total", "Фотографии, которые не удалось скачать")
+
+
+def photo_path(root, file_unique_id):
+    """Файл в архиве по file_unique_id; подкаталог по первым символам, чтобы каталоги не разрастались."""
+    return os.path.join(root, file_unique_id[:2], file_unique_id + ".jpg")
+
+
+def find(root=ARCHIVE_DIR, user_id=None, quest_id=None, task=None):
+    """Записи индекса архива, подходящие под фильтр (читает индекс потоком)."""
+    try:
+        file = open(os.path.join(root, INDEX_FILE), "r", encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if user_id is not None and entry["user"] != user_id:
+                continue
+            if quest_id is not None and entry["quest"] != quest_id:
+                continue
+            if task is not None and entry["task"] != task:
+                continue
+            yield entry
+
+
+class PhotoArchiver:
+    """
+    Фоновое скачивание принятых фото в локальный архив.
+
+    Обработчик только кладёт фото в очередь (put_nowait) и сразу отвечает
+    игроку; если очередь переполнена, фото не архивируется, а пересылка
+    в админский чат всё равно уходит. Очередь разбирают workers задач,
+    каждая скачивает через bot.download прямо в файл, кусками, не держа
+    его в памяти.
+
+    Файл называется по file_unique_id (он один у одной и той же фотографии,
+    даже пересланной заново), поэтому повторная отправка не скачивается
+    второй раз. Каждое принятое фото дописывается в index.ndjson:
+    игрок, квест, задание, file_unique_id и путь к файлу.
+    """
+
+    def __init__(self, bot: Bot, root=ARCHIVE_DIR, workers=ARCHIVE_WORKERS,
+                 queue_size=ARCHIVE_QUEUE_SIZE, registry=registry):
+        self.bot = bot
+        self.root = root
+        self.workers = workers
+        os.makedirs(root, exist_ok=True)
+        self._index = open(os.path.join(root, INDEX_FILE), "a", encoding="utf-8")
+        self._queue = asyncio.Queue(queue_size)
+        self._downloading = {}  # file_unique_id -> Event, пока файл качается
+        self._tasks = []
+        self._active = 0
+        self._registry = registry
+        self._download_time = registry.histogram("archive_download_seconds")
+        registry.gauge("archive_backlog", lambda: self.backlog)
+        registry.gauge("archive_downloading", lambda: self._active)
+
+    @property
+    def backlog(self):
+        """Фото в очереди и в процессе скачивания."""
+        return self._queue.qsize() + self._active
+
+    def submit(self, message: types.Message, quest_id, task):
+        """Ставит самое большое превью фото из сообщения в очередь архива."""
+        photo = message.photo[-1]
+        entry = {
+            "ts": round(time.time(), 3),
+            "user": message.from_user.id,
+            "quest": quest_id,
+            "task": task,
+            "message_id": message.message_id,
+            "file_unique_id": photo.file_unique_id,
+            "path": os.path.relpath(photo_path(self.root, photo.file_unique_id), self.root),
+        }
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            self._queue.put_nowait((photo.file_id, entry))
+        except asyncio.QueueFull:
+            self._registry.inc("archive_dropped_total")
+            logger.warning("Очередь архива переполнена, фото %s не сохранено", photo.file_unique_id)
+
+    async def _worker(self):
+        while True:
+            file_id, entry = await self._queue.get()
+            self._active += 1
+            try:
+                if await self._store(file_id, entry["file_unique_id"]):
+                    self._index.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    self._index.flush()
+            except Exception:
+                logger.exception("Ошибка архивирования фото %s", entry["file_unique_id"])
+            finally:
+                self._active -= 1
+                self._queue.task_done()
+
+    async def _store(self, file_id, file_unique_id):
+        """Скачивает фото, если его ещё нет в архиве. True — файл в архиве."""
+        path = photo_path(self.root, file_unique_id)
+        # Ту же фотографию может сейчас качать другая задача
+        while (downloading := self._downloading.get(file_unique_id)) is not None:
+            await downloading.wait()
+        if os.path.exists(path):
+            self._registry.inc("archive_deduplicated_total")
+            return True
+
+        self._downloading[file_unique_id] = asyncio.Event()
+        try:
+            return await self._download(file_id, path)
+        finally:
+            self._downloading.pop(file_unique_id).set()
+
+    async def _download(self, file_id, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Воркеры шардов пишут в один архив: у каждого процесса свой временный файл
+        tmp_path = f"{path}.{os.getpid()}.part"
+        delay = 1
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            started = time.perf_counter()
+            try:
+                await self.bot.download(file_id, destination=tmp_path)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError, ClientError, asyncio.TimeoutError, OSError) as e:
+                logger.warning("Не удалось скачать %s (попытка %d): %s", file_id, attempt, e)
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+            self._download_time.observe(time.perf_counter() - started)
+            # Недокачанный файл не должен выглядеть как готовый
+            os.replace(tmp_path, path)
+            self._registry.inc("archive_downloaded_total")
+            self._registry.inc("archive_bytes_total", os.path.getsize(path))
+            return True
+        self._registry.inc("archive_errors_total")
+        logger.error("Фото %s не сохранено в архив", file_id)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    async def close(self, timeout=10):
+        """Дожидается очереди (не дольше timeout) и останавливает скачивание."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error("Не сохранено в архив при остановке: %d", self.backlog)
+        for task in self._tasks:
+            task.cancel()
+        self._index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=ARCHIVE_DIR)
+    parser.add_argument("--user", type=int)
+    parser.add_argument("--quest")
+    parser.add_argument("--task")
+    args = parser.parse_args()
+    for entry in find(args.dir, args.user, args.quest, args.task):
+        print(entry["user"], entry["quest"], entry["task"], os.path.join(args.dir, entry["path"]))
+
+
+if __name__ == "__main__":
+    main()
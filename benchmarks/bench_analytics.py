@@ -0,0 +1,128 @@
+"""
+Аналитика квестов: стоимость записи события, ответа /stats и пересборки.
+
+Журнал наполняется событиями N игроков, прошедших квест quests/subotica.json.
+/stats по готовой сводке сравнивается с подсчётом по всему журналу заново,
+как пришлось бы без сводки. Сначала проверяется, что журнал воркера
+переживает перезапуск и что /stats сразу видит события других воркеров.
+
+Запуск: python benchmarks/bench_analytics.py [игроков ...]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics import Analytics, Stats, format_stats, read_events
+from bench_quest import QUEST_PATH
+
+
+def fill(analytics, quest, players, rng):
+    """События игроков, как их пишет QuestEngine; возвращает их число."""
+    events = 0
+    for user_id in range(players):
+        steps = quest["steps"]
+        analytics.record("start", quest["id"], user_id, steps[0]["id"])
+        events += 1
+        for step in steps:
+            fields = {"dur": round(rng.expovariate(1 / 300), 1)}
+            if step["type"] == "answer":
+                limit = step.get("attempts", 3)
+                attempts = min(limit, 1 + int(rng.expovariate(2)))
+                solved = attempts < limit or rng.random() < 0.5
+                for attempt in range(1, attempts + 1):
+                    ok = solved and attempt == attempts
+                    analytics.record("answer", quest["id"], user_id, step["id"], ok=ok, n=attempt)
+                events += attempts
+                fields.update(ok=solved, n=attempts)
+            elif step["type"] == "photos":
+                analytics.record("photo", quest["id"], user_id, step["id"], n=step.get("count", 1))
+                events += 1
+            analytics.record("stage", quest["id"], user_id, step["id"], **fields)
+            events += 1
+        analytics.record("done", quest["id"], user_id, steps[-1]["id"])
+        events += 1
+    return events
+
+
+def bench(players, tmp):
+    with open(QUEST_PATH, encoding="utf-8") as file:
+        quest = json.load(file)
+    path = os.path.join(tmp, f"analytics-{players}.ndjson")
+    analytics = Analytics(path)
+    started = time.perf_counter()
+    events = fill(analytics, quest, players, random.Random(1))
+    record_cost = (time.perf_counter() - started) / events
+    analytics.close()
+
+    started = time.perf_counter()
+    format_stats(analytics.stats)
+    stats_cost = time.perf_counter() - started
+
+    started = time.perf_counter()
+    stats = Stats()
+    for event, _, _ in read_events(path):
+        stats.apply(event)
+    format_stats(stats)
+    scan_cost = time.perf_counter() - started
+
+    started = time.perf_counter()
+    Analytics(path).close()
+    restart_cost = time.perf_counter() - started
+
+    size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp) if name.startswith(os.path.basename(path)))
+    print(
+        f"{players:>7} игроков, {events:>8} событий, {size / 2 ** 20:6.1f} МБ"
+        f" | запись {record_cost * 1e6:5.1f} мкс"
+        f" | /stats {stats_cost * 1e3:6.2f} мс, по журналу {scan_cost * 1e3:8.1f} мс"
+        f" | запуск со снимком {restart_cost * 1e3:6.2f} мс"
+    )
+
+
+def check_worker_restart(tmp):
+    """Журнал воркера после перезапуска: ни одно событие не потеряно."""
+    with open(QUEST_PATH, encoding="utf-8") as file:
+        quest = json.load(file)
+    path = os.path.join(tmp, "analytics-restart.ndjson")
+    analytics = Analytics(path, worker="1")
+    fill(analytics, quest, 10, random.Random(1))
+    analytics.close()
+    size = os.path.getsize(analytics.path)
+    reopened = Analytics(path, worker="1")
+    reopened.close()
+    if os.path.getsize(reopened.path) != size or reopened.stats.to_dict() != analytics.stats.to_dict():
+        raise SystemExit(f"Журнал воркера {reopened.path} испорчен после перезапуска")
+    print(f"перезапуск воркера: журнал {size} Б и сводка сохранились")
+
+
+def check_other_workers(tmp):
+    """combined_stats() одного воркера видит события другого, не дожидаясь его снимка."""
+    with open(QUEST_PATH, encoding="utf-8") as file:
+        quest = json.load(file)
+    path = os.path.join(tmp, "analytics-workers.ndjson")
+    first, second = Analytics(path, worker="0"), Analytics(path, worker="1")
+    for players in (5, 10):
+        fill(second, quest, players, random.Random(players))
+        if first.combined_stats().to_dict() != second.stats.to_dict():
+            raise SystemExit(f"/stats воркера {first.path} не видит событий {second.path}")
+    first.close()
+    second.close()
+    print(f"другие воркеры: /stats видит {os.path.getsize(second.path)} Б чужого журнала без снимка")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 100_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        check_worker_restart(tmp)
+        check_other_workers(tmp)
+        for players in sizes:
+            bench(players, tmp)
+
+
+if __name__ == "__main__":
+    main()
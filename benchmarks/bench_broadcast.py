@@ -0,0 +1,137 @@
+"""
+Рассылка всем оплатившим: скорость, 429 и продолжение после остановки.
+
+FakeTelegram ограничивает общую скорость отправки (--flood-limit сообщений
+в секунду, сверх — 429 с retry_after) и отвечает 403 за часть игроков,
+заблокировавших бота.
+
+- "всё сразу": по запросу на игрока одновременно, 429 обрабатывается
+  ожиданием retry_after и повтором, — как без общего ограничителя;
+- Broadcaster: общий TokenBucket на --rate сообщений в секунду;
+- остановка посередине (close(), как при SIGTERM) и resume() новым
+  Broadcaster'ом в том же каталоге: кто не получил сообщение, кто получил дважды;
+- повторная рассылка: к заблокировавшим бота запросов уже нет.
+
+Запуск без сети:
+  python benchmarks/bench_broadcast.py --players 600 --rate 25 --flood-limit 30
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from broadcast import Broadcaster, BlockedUsers
+from fake_telegram import FakeTelegram
+
+ADMIN_ID = 1
+FIRST_PLAYER_ID = 300_000
+
+
+def received(telegram, players, since):
+    counts = collections.Counter(
+        chat_id for _, method, chat_id, _ in telegram.replies[since:] if method == "copyMessage"
+    )
+    return [counts[user_id] for user_id in players]
+
+
+async def send_all_at_once(bot, players):
+    async def send(user_id):
+        while True:
+            try:
+                await bot.copy_message(user_id, ADMIN_ID, 1)
+                return
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return
+
+    await asyncio.gather(*(send(user_id) for user_id in players))
+
+
+async def broadcast(bot, players, workdir, rate, stop_after=None):
+    """Рассылка Broadcaster'ом; stop_after — остановить через столько секунд и продолжить заново."""
+    def make():
+        return Broadcaster(
+            bot, lambda: iter(players), lambda user_id: True,
+            state_path=os.path.join(workdir, "broadcast.json"),
+            blocked_users=BlockedUsers(os.path.join(workdir, "blocked_users.txt")),
+            rate=rate,
+        )
+
+    broadcaster = make()
+    broadcaster.start(ADMIN_ID, {"from_chat_id": ADMIN_ID, "message_id": 1})
+    if stop_after is not None:
+        await asyncio.sleep(stop_after)
+        await broadcaster.close()
+        broadcaster = make()
+        if not broadcaster.resume():
+            print(f"рассылка закончилась раньше, чем через {stop_after:g} с: продолжать нечего")
+            return broadcaster
+    await broadcaster._task
+    return broadcaster
+
+
+def report(title, telegram, players, since, started, before):
+    counts = received(telegram, players, since)
+    elapsed = time.perf_counter() - started
+    retry_after, forbidden = telegram.retry_after_sent - before[0], telegram.forbidden_sent - before[1]
+    print(
+        f"{title:<24} {elapsed:6.1f} с, {sum(1 for count in counts if count) / elapsed:5.1f} сообщ./с"
+        f" | 429: {retry_after:5d}, 403: {forbidden:3d}"
+        f" | не получили {sum(1 for user_id, count in zip(players, counts) if not count and user_id not in telegram.blocked_chats):3d},"
+        f" дважды {sum(1 for count in counts if count > 1):3d}"
+    )
+
+
+async def main(args):
+    players = [FIRST_PLAYER_ID + i for i in range(args.players)]
+    blocked = set(random.Random(1).sample(players, int(len(players) * args.blocked)))
+    telegram = FakeTelegram(
+        latency=args.latency, flood_limit=args.flood_limit, retry_after=args.retry_after, blocked_chats=blocked,
+    )
+    await telegram.start()
+    bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(telegram.base_url)))
+    print(f"игроков {len(players)}, заблокировали бота {len(blocked)}, лимит Telegram {args.flood_limit}/с")
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            runs = [
+                ("всё сразу", lambda: send_all_at_once(bot, players)),
+                (f"Broadcaster {args.rate:g}/с", lambda: broadcast(bot, players, workdir, args.rate)),
+                (f"остановка через {args.stop_after:g} с", lambda: broadcast(
+                    bot, players, workdir, args.rate, stop_after=args.stop_after)),
+                ("повторная рассылка", lambda: broadcast(bot, players, workdir, args.rate)),
+            ]
+            for title, run in runs:
+                # Пауза, чтобы лимит Telegram от прошлого прогона не мешал следующему
+                await asyncio.sleep(1)
+                since, before = len(telegram.replies), (telegram.retry_after_sent, telegram.forbidden_sent)
+                started = time.perf_counter()
+                await run()
+                report(title, telegram, players, since, started, before)
+    finally:
+        await bot.session.close()
+        await telegram.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=600)
+    parser.add_argument("--rate", type=float, default=25, help="скорость Broadcaster, сообщений в секунду")
+    parser.add_argument("--flood-limit", type=int, default=30, help="лимит Telegram, сообщений в секунду")
+    parser.add_argument("--retry-after", type=int, default=3, help="retry_after в ответах 429, с")
+    parser.add_argument("--latency", type=float, default=0.1, help="задержка ответа Bot API, с")
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля заблокировавших бота")
+    parser.add_argument("--stop-after", type=float, default=10, help="когда остановить рассылку, с")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,188 @@
+"""
+Обращения к FSM-хранилищу на одно обновление: встроенный FSMContext aiogram
+против TransactionalFSMMiddleware (одно чтение и одна запись на обновление).
+
+Игроки проходят квест quests/subotica.json через настоящий Dispatcher
+и QuestEngine, запросы к Bot API подменены заглушкой. --rtt добавляет
+задержку на каждое обращение к хранилищу, как у сетевого бэкенда (Redis и т.п.).
+
+Запуск: python benchmarks/bench_fsm_transaction.py [--players 200] [--rtt 0.5]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.filters import Command
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.types import Message, Update
+
+from bench_quest import QUEST_PATH, plan_player
+from fsm_storage import SQLiteStorage, TransactionalFSMMiddleware
+from quest_engine import QuestEngine
+
+
+class NullSession(BaseSession):
+    """Отвечает на запросы к Bot API сразу, без сети."""
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, (SendMessage, SendPhoto)):
+            return Message(message_id=1, date=0, chat={"id": method.chat_id, "type": "private"})
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class NullOutbound:
+    def forward(self, *args):
+        pass
+
+    def forward_many(self, *args):
+        pass
+
+    def send_text(self, *args):
+        pass
+
+
+class CountingStorage(BaseStorage):
+    """Считает обращения к хранилищу и при желании добавляет им задержку."""
+
+    def __init__(self, storage, rtt=0.0):
+        self.storage = storage
+        self.rtt = rtt
+        self.calls = collections.Counter()
+        if hasattr(storage, "get_state_and_data"):
+            self.get_state_and_data = self._get_state_and_data
+            self.set_state_and_data = self._set_state_and_data
+
+    async def _call(self, name, *args):
+        self.calls[name] += 1
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        return await getattr(self.storage, name)(*args)
+
+    async def set_state(self, key, state=None):
+        await self._call("set_state", key, state)
+
+    async def get_state(self, key):
+        return await self._call("get_state", key)
+
+    async def set_data(self, key, data):
+        await self._call("set_data", key, data)
+
+    async def get_data(self, key):
+        return await self._call("get_data", key)
+
+    async def _get_state_and_data(self, key):
+        return await self._call("get_state_and_data", key)
+
+    async def _set_state_and_data(self, key, state, data):
+        await self._call("set_state_and_data", key, state, data)
+
+    async def close(self):
+        await self.storage.close()
+
+
+def make_dispatcher(storage, transactional):
+    dp = Dispatcher(storage=storage, disable_fsm=transactional)
+    if transactional:
+        dp.update.outer_middleware(TransactionalFSMMiddleware(storage, dp.fsm.events_isolation))
+    engine = QuestEngine(NullOutbound(), admin_chat_id=-1)
+    quest = engine.load(QUEST_PATH)
+
+    @dp.message(Command("start"))
+    async def start(message, state):
+        await engine.start(message, state, quest)
+
+    dp.include_router(engine.router)
+    return dp
+
+
+def make_updates(players, wrong_rate, seed):
+    """Обновления игроков по очереди: каждый игрок делает свой следующий ход."""
+    with open(QUEST_PATH, encoding="utf-8") as file:
+        quest = json.load(file)
+    rng = random.Random(seed)
+    plans = [plan_player(quest, rng, wrong_rate) for _ in range(players)]
+    updates, update_id = [], 0
+    for turn in range(max(len(plan) for plan in plans)):
+        for player, plan in enumerate(plans):
+            if turn >= len(plan):
+                continue
+            text, photo, _ = plan[turn]
+            update_id += 1
+            message = {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": 1000 + player, "type": "private"},
+                "from": {"id": 1000 + player, "is_bot": False, "first_name": "Player"},
+            }
+            if photo:
+                message["photo"] = [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}]
+            else:
+                message["text"] = text
+                if text.startswith("/"):
+                    message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+            updates.append({"update_id": update_id, "message": message})
+    return updates
+
+
+async def run(name, storage, transactional, raw_updates, rtt):
+    counting = CountingStorage(storage, rtt)
+    dp = make_dispatcher(counting, transactional)
+    bot = Bot("42:benchmark", session=NullSession())
+    updates = [Update.model_validate(update, context={"bot": bot}) for update in raw_updates]
+    durations = []
+
+    async def feed(update):
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        durations.append(time.perf_counter() - started)
+
+    # Игроки ходят параллельно, как при обработке обновлений задачами в polling
+    for offset in range(0, len(updates), 100):
+        await asyncio.gather(*(feed(update) for update in updates[offset:offset + 100]))
+    await counting.close()
+    ops = sum(counting.calls.values())
+    details = ", ".join(f"{op} {count / len(updates):.2f}" for op, count in sorted(counting.calls.items()))
+    print(
+        f"{name:>30}: {ops / len(updates):5.2f} обращений/обновление"
+        f" | обработка {statistics.mean(durations) * 1e3:6.2f} мс | {details}"
+    )
+
+
+async def main(args):
+    raw_updates = make_updates(args.players, args.wrong_rate, args.seed)
+    print(f"{args.players} игроков, {len(raw_updates)} обновлений, задержка хранилища {args.rtt} мс")
+    with tempfile.TemporaryDirectory() as tmp:
+        for transactional in (False, True):
+            mode = "транзакция" if transactional else "FSMContext"
+            await run(f"MemoryStorage, {mode}", MemoryStorage(), transactional, raw_updates, args.rtt / 1000)
+            path = os.path.join(tmp, f"fsm-{transactional}.sqlite3")
+            await run(f"SQLiteStorage, {mode}", SQLiteStorage(path), transactional, raw_updates, args.rtt / 1000)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--rtt", type=float, default=0.0, help="задержка обращения к хранилищу, мс")
+    parser.add_argument("--wrong-rate", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
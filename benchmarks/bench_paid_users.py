@@ -0,0 +1,75 @@
+"""
+Стоимость изменения списка оплативших: полная перезапись JSON против журнала.
+
+Для каждого размера списка меряется загрузка, одно add_user/remove_user
+и проверка is_user_paid.
+
+Запуск: python benchmarks/bench_paid_users.py [размер ...]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import PaidUsersStore
+
+CHANGES = 200
+
+
+def full_rewrite(path, users):
+    """Старый способ: весь список сериализуется на каждое изменение."""
+    with open(path, "w") as file:
+        json.dump(list(users), file)
+
+
+def bench(size, tmp):
+    snapshot = os.path.join(tmp, f"paid_{size}.json")
+    journal = os.path.join(tmp, f"paid_{size}.journal")
+    users = set(range(1_000_000_000, 1_000_000_000 + size))
+    full_rewrite(snapshot, users)
+
+    rewrites = max(1, min(CHANGES, 2_000_000 // size))
+    started = time.perf_counter()
+    for i in range(rewrites):
+        users.add(i)
+        full_rewrite(snapshot + ".old", users)
+    rewrite_cost = (time.perf_counter() - started) / rewrites
+
+    started = time.perf_counter()
+    store = PaidUsersStore(snapshot, journal, compact_threshold=10 ** 9)
+    load_cost = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(CHANGES):
+        if i % 2:
+            store.remove(i)
+        else:
+            store.add(i)
+    journal_cost = (time.perf_counter() - started) / CHANGES
+
+    started = time.perf_counter()
+    for i in range(100_000):
+        store.is_paid(1_000_000_000 + i)
+    lookup_cost = (time.perf_counter() - started) / 100_000
+    store.close()
+
+    print(
+        f"{size:>9} | загрузка {load_cost * 1e3:9.1f} мс"
+        f" | перезапись JSON {rewrite_cost * 1e3:9.2f} мс"
+        f" | запись в журнал {journal_cost * 1e3:7.3f} мс"
+        f" | проверка {lookup_cost * 1e9:5.0f} нс"
+    )
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            bench(size, tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Нагрузочный прогон квеста: N игроков одновременно проходят все шаги.
+
+bot.py запускается отдельным процессом против FakeTelegram. Каждый игрок
+начинает с /start и идёт по шагам из quests/*.json: иногда ошибается
+в ответе, иногда присылает текст вместо фото. Следующее сообщение игрок
+отправляет, только получив все ответы бота на предыдущее, как живой человек.
+
+Отчёт: обновлений и ответов в секунду, задержка от обновления до первого
+ответа и до последнего ответа (p50/p95/p99), число "застрявших" игроков,
+которые не дождались ответа (например, ответ потерялся из-за 429).
+
+Запуск без сети:
+  python benchmarks/bench_quest.py --players 200 --latency 0.05 --retry-after-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_transport import ADMIN_CHAT_ID, BOT_PATH, percentile, start_bot
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(BOT_PATH)
+QUEST_PATH = os.path.join(ROOT, "quests", "subotica.json")
+FIRST_PLAYER_ID = 100_000
+REPLY_TIMEOUT = 10
+
+
+def plan_player(quest, rng, wrong_rate):
+    """
+    Сообщения одного игрока: список (текст, фото, сколько ответов бота ждать).
+
+    Число ответов выводится из описания квеста: шаг, который продвигает
+    игрока, отвечает сам и присылает задание следующего шага.
+    """
+    actions = [("/start", False, 2 if quest.get("welcome", {}).get("caption") else 1)]
+    steps = quest["steps"]
+    for index, step in enumerate(steps):
+        advance = 2 if index + 1 < len(steps) else 1
+        if step["type"] == "answer":
+            attempts = step.get("attempts", 3)
+            for _ in range(attempts - 1):
+                if rng.random() >= wrong_rate:
+                    break
+                actions.append(("неверный ответ", False, 1))
+            actions.append((step["answers"][0], False, advance))
+        elif step["type"] == "photos":
+            if rng.random() < wrong_rate:
+                actions.append(("а можно без фото?", False, 1))
+            count = step.get("count", 1)
+            actions += [(None, True, 1)] * (count - 1)
+            actions.append((None, True, advance))
+        else:
+            actions.append(("мой ответ", False, advance))
+    return actions
+
+
+async def play(telegram, user_id, actions, stats):
+    for text, photo, replies in actions:
+        waiter = telegram.wait_replies(user_id, replies)
+        started = time.perf_counter()
+        await telegram.send_update(telegram.make_message_update(user_id, text, photo=photo))
+        try:
+            times = await asyncio.wait_for(waiter, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            stats["stuck"] += 1
+            return
+        stats["first"].append(times[0] - started)
+        stats["last"].append(times[-1] - started)
+        stats["updates"] += 1
+    stats["finished"] += 1
+
+
+def report(name, values):
+    print(
+        f"{name:>16}: p50 {percentile(values, 50) * 1e3:7.2f} мс"
+        f" | p95 {percentile(values, 95) * 1e3:7.2f} мс"
+        f" | p99 {percentile(values, 99) * 1e3:7.2f} мс"
+        f" | среднее {statistics.mean(values) * 1e3:7.2f} мс"
+    )
+
+
+async def main(args):
+    with open(QUEST_PATH, encoding="utf-8") as file:
+        quest = json.load(file)
+    rng = random.Random(args.seed)
+    player_ids = [FIRST_PLAYER_ID + i for i in range(args.players)]
+    plans = {user_id: plan_player(quest, rng, args.wrong_rate) for user_id in player_ids}
+
+    telegram = FakeTelegram(
+        latency=args.latency,
+        retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after,
+        throttled_chats=None if args.throttle_players else {ADMIN_CHAT_ID},
+        seed=args.seed,
+    )
+    await telegram.start()
+    if args.workers > 1:
+        os.environ["WORKERS"] = str(args.workers)
+    stats = {"first": [], "last": [], "updates": 0, "finished": 0, "stuck": 0}
+    with tempfile.TemporaryDirectory() as workdir:
+        shutil.copy(os.path.join(ROOT, "welcome.jpg"), workdir)
+        with open(os.path.join(workdir, "paid_users.json"), "w") as file:
+            json.dump(player_ids, file)
+        process = await start_bot(telegram, workdir, args.mode)
+        replies_before = len(telegram.replies)
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(play(telegram, user_id, plans[user_id], stats) for user_id in player_ids))
+            elapsed = time.perf_counter() - started
+        finally:
+            process.terminate()
+            await process.wait()
+            await telegram.stop()
+
+    photos = sum(photo for actions in plans.values() for _, photo, _ in actions)
+    replies = len(telegram.replies) - replies_before
+    print(
+        f"{args.mode}, воркеров {args.workers}: игроков {args.players}, прошли квест {stats['finished']},"
+        f" застряли {stats['stuck']}; {elapsed:.1f} с"
+    )
+    print(
+        f"{stats['updates'] / elapsed:7.0f} обновлений/с | {replies / elapsed:7.0f} ответов/с"
+        f" | 429 отдано: {telegram.retry_after_sent}"
+        f" | переслано фото в админский чат за прогон: {telegram.forwarded.get(ADMIN_CHAT_ID, 0)} из {photos}"
+    )
+    if stats["first"]:
+        report("до 1-го ответа", stats["first"])
+        report("до всех ответов", stats["last"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=100, help="одновременных игроков")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--workers", type=int, default=1, help="WORKERS для bot.py")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля запросов с ответом 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, с")
+    parser.add_argument(
+        "--throttle-players", action="store_true",
+        help="отдавать 429 и на ответы игрокам (по умолчанию только админскому чату)",
+    )
+    parser.add_argument("--wrong-rate", type=float, default=0.3, help="вероятность ошибки игрока")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
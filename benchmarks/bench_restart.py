@@ -0,0 +1,97 @@
+"""
+Перезапуск бота под нагрузкой: теряются ли обновления и сколько до первого ответа.
+
+bot.py запускается против FakeTelegram, получает пачку /id от разных игроков
+и сразу же SIGTERM, пока ответы ещё отправляются (--latency задерживает
+каждый ответ Bot API). Пока бот остановлен, приходят ещё обновления.
+Затем бот запускается заново в том же каталоге.
+
+Отчёт: сколько игроков получили ответ до остановки и после перезапуска,
+сколько остались без ответа и сколько получили его дважды; время
+от запуска процесса до первого ответа и до последнего.
+
+Запуск без сети:
+  python benchmarks/bench_restart.py --players 200 --latency 0.2 [--workers 2]
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_transport import start_bot, spawn_bot
+from fake_telegram import FakeTelegram
+
+FIRST_PLAYER_ID = 200_000
+RESTART_TIMEOUT = 60
+
+
+def replies_by_chat(telegram, players, since=0):
+    counts = collections.Counter(chat_id for _, _, chat_id, _ in telegram.replies[since:])
+    return {user_id: counts[user_id] for user_id in players}
+
+
+async def main(args):
+    telegram = FakeTelegram(latency=args.latency)
+    await telegram.start()
+    if args.workers > 1:
+        os.environ["WORKERS"] = str(args.workers)
+    before = [FIRST_PLAYER_ID + i for i in range(args.players)]
+    during = [FIRST_PLAYER_ID + args.players + i for i in range(args.players)]
+    with tempfile.TemporaryDirectory() as workdir:
+        process = await start_bot(telegram, workdir, "polling")
+        since = len(telegram.replies)
+        for user_id in before:
+            await telegram.send_update(telegram.make_message_update(user_id, "/id"))
+        # Бот забрал пачку и отправляет ответы — тут его и останавливаем
+        await asyncio.sleep(args.stop_after)
+        stopping = time.perf_counter()
+        process.terminate()
+        await process.wait()
+        stop_time = time.perf_counter() - stopping
+        answered = sum(1 for count in replies_by_chat(telegram, before, since).values() if count)
+
+        for user_id in during:
+            await telegram.send_update(telegram.make_message_update(user_id, "/id"))
+        waiting = [user_id for user_id, count in replies_by_chat(telegram, before + during, since).items() if not count]
+        waiters = [telegram.wait_reply(user_id) for user_id in waiting]
+        started = time.perf_counter()
+        process = await spawn_bot(telegram, workdir)
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=RESTART_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+            if done:
+                await asyncio.wait(waiters, timeout=RESTART_TIMEOUT)
+            # Повторные ответы (обработали дважды) пришли бы сразу за первыми
+            await asyncio.sleep(args.settle)
+        finally:
+            process.terminate()
+            await process.wait()
+            await telegram.stop()
+
+    times = [waiter.result() - started for waiter in waiters if waiter.done() and not waiter.cancelled()]
+    counts = replies_by_chat(telegram, before + during, since)
+    print(
+        f"воркеров {args.workers}: игроков {len(before)} до остановки и {len(during)} во время простоя;"
+        f" остановка заняла {stop_time:.2f} с"
+    )
+    print(
+        f"ответ до остановки: {answered}, после перезапуска: {len(times)},"
+        f" без ответа: {sum(1 for count in counts.values() if not count)},"
+        f" ответ дважды: {sum(1 for count in counts.values() if count > 1)}"
+    )
+    if times:
+        print(f"от запуска процесса до первого ответа {min(times):.2f} с, до последнего {max(times):.2f} с")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=100, help="игроков в каждой пачке")
+    parser.add_argument("--workers", type=int, default=1, help="WORKERS для bot.py")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка ответа Bot API, с")
+    parser.add_argument("--stop-after", type=float, default=0.1, help="через сколько после пачки послать SIGTERM, с")
+    parser.add_argument("--settle", type=float, default=1.0, help="сколько ждать повторных ответов, с")
+    asyncio.run(main(parser.parse_args()))
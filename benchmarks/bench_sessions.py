@@ -0,0 +1,120 @@
+"""
+Память и стоимость таймеров простоя для N игровых сессий.
+
+- записи FSM в памяти SQLiteStorage: N игроков посередине квеста
+  и после выгрузки молчащих (evict);
+- таймеры простоя: TimerWheel против задачи asyncio на игрока
+  (asyncio.sleep до срока, отмена и новая задача при каждом сообщении) —
+  память, стоимость перестановки таймера и одного деления колеса.
+
+Запуск: python benchmarks/bench_sessions.py [сессий ...]
+"""
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import SQLiteStorage
+from sessions import TimerWheel, EVICT_AFTER, REMIND_AFTER
+
+BOT_ID = 42
+FIRST_PLAYER_ID = 100_000
+
+
+def measure(build):
+    """Байты, которые занимает результат build(), и время его построения."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+async def bench_storage(sessions, tmp):
+    storage = SQLiteStorage(os.path.join(tmp, f"fsm-{sessions}.sqlite3"))
+    keys = [StorageKey(bot_id=BOT_ID, chat_id=chat_id, user_id=chat_id)
+            for chat_id in range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + sessions)]
+    gc.collect()
+    tracemalloc.start()
+    for key in keys:
+        await storage.set_state_and_data(
+            key, "subotica:question2", {"attempts": 1, "photo_count": 0, "entered_at": time.time()},
+        )
+    await storage.flush()
+    cached = tracemalloc.get_traced_memory()[0]
+    for key in keys:
+        storage.evict(key)
+    gc.collect()
+    evicted = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    await storage.close()
+    print(
+        f"{sessions:>7} сессий | FSM в памяти {cached / 2 ** 20:7.1f} МБ ({cached / sessions:4.0f} Б на игрока),"
+        f" после выгрузки {evicted / 2 ** 20:6.1f} МБ"
+    )
+
+
+async def bench_timers(sessions):
+    chats = range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + sessions)
+
+    def fill_wheel():
+        wheel = TimerWheel()
+        for chat_id in chats:
+            wheel.schedule(chat_id, EVICT_AFTER + chat_id % REMIND_AFTER)
+        return wheel
+
+    wheel, wheel_size, _ = measure(fill_wheel)
+    # Сроки разбросаны на несколько оборотов: деление просматривает свою ячейку, ничего не снимая
+    started = time.perf_counter()
+    for _ in range(1000):
+        wheel._current -= 1
+        wheel.advance()
+    wheel_tick = (time.perf_counter() - started) / 1000
+    started = time.perf_counter()
+    for chat_id in chats:
+        wheel.schedule(chat_id, EVICT_AFTER)
+    wheel_touch = (time.perf_counter() - started) / sessions
+
+    def fill_tasks():
+        return {chat_id: asyncio.create_task(asyncio.sleep(EVICT_AFTER)) for chat_id in chats}
+
+    tasks, tasks_size, _ = measure(fill_tasks)
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    for chat_id in chats:
+        tasks[chat_id].cancel()
+        tasks[chat_id] = asyncio.create_task(asyncio.sleep(EVICT_AFTER))
+    await asyncio.sleep(0)
+    tasks_touch = (time.perf_counter() - started) / sessions
+    for task in tasks.values():
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    print(
+        f"{sessions:>7} таймеров | колесо {wheel_size / 2 ** 20:6.1f} МБ, перестановка {wheel_touch * 1e6:4.1f} мкс,"
+        f" деление {wheel_tick * 1e6:5.1f} мкс"
+        f" | задачи asyncio {tasks_size / 2 ** 20:6.1f} МБ, перестановка {tasks_touch * 1e6:5.1f} мкс"
+    )
+
+
+async def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for sessions in sizes:
+            await bench_storage(sessions, tmp)
+            await bench_timers(sessions)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+"""
+Сравнение long polling и webhook на локальной замене Telegram.
+
+Для каждого режима bot.py запускается отдельным процессом против
+FakeTelegram и получает команды /id:
+  - задержка: обновления по одному, время до ответа бота (p50/p95/p99);
+  - пропускная способность: пачка обновлений сразу, ответов в секунду.
+
+Запуск: python benchmarks/bench_transport.py [обновлений в пачке]
+"""
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+LATENCY_SAMPLES = 200
+ADMIN_CHAT_ID = -1001
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def spawn_bot(telegram, workdir, mode="polling"):
+    """Запускает bot.py против FakeTelegram, не дожидаясь готовности."""
+    env = dict(
+        os.environ,
+        BOT_TOKEN="42:benchmark",
+        ADMIN_ID="1",
+        CHAT_ID=str(ADMIN_CHAT_ID),
+        TELEGRAM_API_URL=telegram.base_url,
+        QUESTS_DIR=os.path.join(os.path.dirname(BOT_PATH), "quests"),
+    )
+    env.pop("WEBHOOK_URL", None)
+    if mode == "webhook":
+        port = free_port()
+        env.update(WEBHOOK_URL=f"http://127.0.0.1:{port}/webhook", WEBHOOK_SECRET="bench", PORT=str(port))
+    return await asyncio.create_subprocess_exec(
+        sys.executable, BOT_PATH, cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+
+async def start_bot(telegram, workdir, mode):
+    process = await spawn_bot(telegram, workdir, mode)
+    # Бот готов, когда ответил на /id
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if mode == "webhook" and telegram.webhook_url is None:
+            await asyncio.sleep(0.05)
+            continue
+        reply = telegram.wait_reply(999)
+        await telegram.send_update(telegram.make_message_update(999, "/id"))
+        try:
+            await asyncio.wait_for(reply, 1)
+            return process
+        except asyncio.TimeoutError:
+            continue
+    process.kill()
+    raise RuntimeError(f"bot.py не запустился в режиме {mode}")
+
+
+async def measure(mode, burst):
+    telegram = FakeTelegram()
+    await telegram.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        process = await start_bot(telegram, workdir, mode)
+        try:
+            latencies = []
+            for i in range(LATENCY_SAMPLES):
+                user_id = 10_000 + i
+                reply = telegram.wait_reply(user_id)
+                started = time.perf_counter()
+                await telegram.send_update(telegram.make_message_update(user_id, "/id"))
+                latencies.append(await asyncio.wait_for(reply, 10) - started)
+
+            replies = [telegram.wait_reply(20_000 + i) for i in range(burst)]
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                telegram.send_update(telegram.make_message_update(20_000 + i, "/id"))
+                for i in range(burst)
+            ))
+            finished = await asyncio.wait_for(asyncio.gather(*replies), 60)
+            throughput = burst / (max(finished) - started)
+        finally:
+            process.terminate()
+            await process.wait()
+            await telegram.stop()
+
+    print(
+        f"{mode:>8}: p50 {percentile(latencies, 50) * 1e3:6.2f} мс"
+        f" | p95 {percentile(latencies, 95) * 1e3:6.2f} мс"
+        f" | p99 {percentile(latencies, 99) * 1e3:6.2f} мс"
+        f" | среднее {statistics.mean(latencies) * 1e3:6.2f} мс"
+        f" | {throughput:7.0f} обновлений/с"
+    )
+
+
+async def main():
+    burst = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for mode in ("polling", "webhook"):
+        await measure(mode, burst)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
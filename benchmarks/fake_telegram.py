@@ -0,0 +1,276 @@
+"""
+Локальная замена Telegram Bot API для нагрузочных тестов.
+
+Бот подключается к ней через TELEGRAM_API_URL. Обновления можно отдавать
+через getUpdates (long polling) или отправлять POST-запросом на webhook бота.
+Каждый исходящий запрос бота к чату фиксируется, чтобы мерить время
+от отправки обновления до ответа.
+
+Для нагрузочных прогонов можно задать задержку ответа API (latency, секунды)
+и долю запросов, на которые вернётся 429 Too Many Requests (retry_after_rate);
+throttled_chats ограничивает 429 заданными чатами (например, админским).
+flood_limit — общий лимит сообщений в секунду, как у настоящего Telegram:
+сверх него тоже 429. Чаты из blocked_chats отвечают 403, как заблокировавшие бота.
+
+getUpdates ведёт себя как настоящий: обновление лежит, пока бот не
+подтвердит его offset'ом больше его update_id, поэтому неподтверждённые
+обновления переживают перезапуск бота; drop_pending_updates их выбрасывает.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+
+from aiohttp import ClientSession, web
+
+
+# Методы, которые отправляют что-то в чат: на них действуют задержка и 429
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "forwardMessage", "forwardMessages", "copyMessage"}
+
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, retry_after_rate=0.0,
+                 retry_after=1, throttled_chats=None, flood_limit=None, blocked_chats=(), seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.throttled_chats = throttled_chats
+        self.flood_limit = flood_limit
+        self.blocked_chats = set(blocked_chats)
+        self.retry_after_sent = 0
+        self.forbidden_sent = 0
+        self._sent_times = collections.deque()  # время отправок за последнюю секунду
+        self.updates = []  # неподтверждённые обновления
+        self._new_updates = asyncio.Event()
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.replies = []  # (время, метод, chat_id, параметры)
+        self.forwarded = {}  # chat_id -> число пересланных сообщений
+        self._reply_waiters = {}
+        self._random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self._client = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._download)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._client = ClientSession()
+
+    async def stop(self):
+        await self._client.close()
+        await self._runner.cleanup()
+
+    # --- Обновления от "игроков" ---
+
+    def make_message_update(self, user_id, text=None, photo=False):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Player", "username": f"player{user_id}"},
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            file_id = f"photo{message['message_id']}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    async def send_update(self, update):
+        """Отдаёт обновление боту: через webhook, если он установлен, иначе через getUpdates."""
+        if self.webhook_url is None:
+            self.updates.append(update)
+            self._new_updates.set()
+            return
+        headers = {}
+        if self.webhook_secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+        async with self._client.post(self.webhook_url, json=update, headers=headers) as response:
+            response.raise_for_status()
+
+    def wait_reply(self, chat_id):
+        """Future, которая завершится при следующем исходящем сообщении в chat_id."""
+        future = asyncio.get_running_loop().create_future()
+        replies = self.wait_replies(chat_id, 1)
+        replies.add_done_callback(lambda done: future.done() or future.set_result(done.result()[0]))
+        # Отменённое ожидание (таймаут) не должно забрать следующий ответ
+        future.add_done_callback(lambda done: done.cancelled() and replies.cancel())
+        return future
+
+    def wait_replies(self, chat_id, count):
+        """Future со временами следующих count исходящих сообщений в chat_id."""
+        future = asyncio.get_running_loop().create_future()
+        self._reply_waiters.setdefault(chat_id, []).append((future, count, []))
+        return future
+
+    # --- Bot API ---
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method in SEND_METHODS:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self._throttled(params) or self._flooded():
+                self.retry_after_sent += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+            if int(params["chat_id"]) in self.blocked_chats:
+                self.forbidden_sent += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 403,
+                    "description": "Forbidden: bot was blocked by the user",
+                }, status=403)
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        result = await handler(params)
+        return web.json_response({"ok": True, "result": result})
+
+    def _throttled(self, params):
+        if not self.retry_after_rate:
+            return False
+        if self.throttled_chats is not None and int(params["chat_id"]) not in self.throttled_chats:
+            return False
+        return self._random.random() < self.retry_after_rate
+
+    def _flooded(self):
+        if self.flood_limit is None:
+            return False
+        now = time.monotonic()
+        while self._sent_times and self._sent_times[0] <= now - 1:
+            self._sent_times.popleft()
+        if len(self._sent_times) >= self.flood_limit:
+            return True
+        self._sent_times.append(now)
+        return False
+
+    async def _download(self, request):
+        return web.Response(body=b"\xff\xd8fake-jpeg:" + request.match_info["path"].encode())
+
+    def _record_reply(self, method, params):
+        chat_id = int(params["chat_id"])
+        now = time.perf_counter()
+        self.replies.append((now, method, chat_id, params))
+        waiters = [waiter for waiter in self._reply_waiters.get(chat_id, ()) if not waiter[0].done()]
+        self._reply_waiters[chat_id] = waiters
+        if waiters:
+            future, count, times = waiters[0]
+            times.append(now)
+            if len(times) == count:
+                waiters.pop(0)
+                future.set_result(times)
+        if not waiters:
+            del self._reply_waiters[chat_id]
+        return self._message(chat_id, text=params.get("text"))
+
+    def _message(self, chat_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    async def api_getMe(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "Quest Bot", "username": "quest_bot"}
+
+    def _drop_pending(self, params):
+        if params.get("drop_pending_updates") == "true":
+            self.updates.clear()
+
+    async def api_deleteWebhook(self, params):
+        self._drop_pending(params)
+        self.webhook_url = None
+        return True
+
+    async def api_setWebhook(self, params):
+        self._drop_pending(params)
+        self.webhook_url = params["url"]
+        self.webhook_secret = params.get("secret_token")
+        return True
+
+    async def api_getUpdates(self, params):
+        timeout = float(params.get("timeout", 0))
+        offset = int(params.get("offset", 0))
+        # Всё, что раньше offset, подтверждено и больше не отдаётся
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout or 0.01)
+            except asyncio.TimeoutError:
+                return []
+        return self.updates[:int(params.get("limit", 100))]
+
+    async def api_sendMessage(self, params):
+        return self._record_reply("sendMessage", params)
+
+    async def api_sendPhoto(self, params):
+        message = self._record_reply("sendPhoto", params)
+        photo = params["photo"]
+        file_id = photo if isinstance(photo, str) else f"uploaded{message['message_id']}"
+        message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}]
+        message["caption"] = params.get("caption")
+        return message
+
+    async def api_forwardMessage(self, params):
+        chat_id = int(params["chat_id"])
+        self.forwarded[chat_id] = self.forwarded.get(chat_id, 0) + 1
+        return self._message(chat_id)
+
+    async def api_forwardMessages(self, params):
+        chat_id = int(params["chat_id"])
+        message_ids = json.loads(params["message_ids"])
+        self.forwarded[chat_id] = self.forwarded.get(chat_id, 0) + len(message_ids)
+        return [{"message_id": next(self._message_ids)} for _ in message_ids]
+
+    async def api_copyMessage(self, params):
+        self._record_reply("copyMessage", params)
+        return {"message_id": next(self._message_ids)}
+
+    async def api_editMessageText(self, params):
+        return self._message(int(params["chat_id"]), text=params.get("text"))
+
+    async def api_getFile(self, params):
+        file_id = params["file_id"]
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_size": 1024,
+            "file_path": f"photos/{file_id}.jpg",
+        }
+
+
+if __name__ == "__main__":
+    async def serve():
+        telegram = FakeTelegram(port=8081)
+        await telegram.start()
+        print(f"Fake Bot API: {telegram.base_url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
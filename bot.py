@@ -1,19 +1,92 @@
 import asyncio
+import csv
+import io
+import json
 import logging
 import os
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
-from aiogram.filters import Command
-from aiogram.fsm.state import State, StatesGroup
+import re
+import signal
+import tempfile
+import time
+from contextlib import suppress
+from datetime import datetime, timezone
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import FSInputFile
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
-from database import is_user_paid, add_user, remove_user
+from database import (
+    is_user_paid, add_users_with_expiry, remove_users, sweep_expired_users, iter_paid_users,
+    watch_paid_users, invalidate_paid_users,
+)
+from fsm_storage import SQLiteStorage, TransactionalFSMMiddleware, FSM_DB_PATH
+from media_group import MediaGroupCollector
+from scheduler import ChatScheduler, MAX_CONCURRENT_UPDATES, CHAT_QUEUE_SIZE
+from media_cache import MediaCache, MEDIA_CACHE_FILE
+from lifecycle import UpdateCheckpoint, UPDATE_OFFSET_FILE, DRAIN_TIMEOUT
+from analytics import Analytics, format_stats, worker_log_path, ANALYTICS_LOG
+from archiver import PhotoArchiver, ARCHIVE_DIR, ARCHIVE_WORKERS
+from broadcast import Broadcaster, BlockedUsers, BROADCAST_RATE, BROADCAST_STATE_FILE, BLOCKED_USERS_FILE
+from sessions import SessionTracker, EVICT_AFTER, REMIND_AFTER
+from outbound import OutboundQueue, RATE_PER_MINUTE, BURST as OUTBOUND_BURST, OUTBOUND_JOURNAL
+from quest_engine import QuestEngine, QUESTS_DIR
+from webhook import run_webhook, WEBHOOK_PATH, WEB_HOST, WEB_PORT
+from sharding import (
+    HashRing, ShardedStorage, WorkerPool, run_polling_front, run_webhook_front, SHARDS, RING_REPLICAS,
+)
+from metrics import (
+    registry, HandlerMetricsMiddleware, ApiMetricsMiddleware, TimedStorage,
+    format_summary, start_metrics_server, METRICS_HOST, METRICS_PORT,
+)
 
 # Настройки бота
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 ADMIN_CHAT_ID = os.getenv("CHAT_ID")
 WELCOME_IMAGE_PATH = "welcome.jpg"
+FSM_DB = os.getenv("FSM_DB_PATH", FSM_DB_PATH)
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", MEDIA_CACHE_FILE)
+QUESTS_PATH = os.getenv("QUESTS_DIR", QUESTS_DIR)
+ADMIN_CHAT_RATE = int(os.getenv("ADMIN_CHAT_RATE", RATE_PER_MINUTE))  # сообщений в минуту
+# Неотправленные пересылки в админский чат переживают перезапуск; у каждого воркера свой журнал
+OUTBOUND_JOURNAL_PATH = os.getenv("OUTBOUND_JOURNAL", OUTBOUND_JOURNAL)
+# Режим webhook включается, если задан WEBHOOK_URL (иначе long polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN_PATH = os.getenv("WEBHOOK_PATH", WEBHOOK_PATH)
+WEB_LISTEN_HOST = os.getenv("WEB_HOST", WEB_HOST)
+WEB_LISTEN_PORT = int(os.getenv("PORT", WEB_PORT))
+# Свой Bot API сервер (локальный telegram-bot-api или тестовый стенд)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Многопроцессный режим: фронт раздаёт обновления WORKERS воркерам по chat_id
+WORKERS = int(os.getenv("WORKERS", 1))
+SHARD_COUNT = int(os.getenv("SHARDS", SHARDS))
+SHARD_RING_REPLICAS = int(os.getenv("SHARD_RING_REPLICAS", RING_REPLICAS))
+PAID_USERS_WRITER = os.getenv("PAID_USERS_READ_ONLY") != "1"
+# Обновления одного чата обрабатываются по очереди, разных чатов — параллельно
+UPDATES_CONCURRENCY = int(os.getenv("MAX_CONCURRENT_UPDATES", MAX_CONCURRENT_UPDATES))
+CHAT_QUEUE_LIMIT = int(os.getenv("CHAT_QUEUE_SIZE", CHAT_QUEUE_SIZE))
+# Метрики Prometheus на локальном порту (0 — выключить); воркеры занимают следующие порты
+METRICS_LISTEN_HOST = os.getenv("METRICS_HOST", METRICS_HOST)
+METRICS_LISTEN_PORT = int(os.getenv("METRICS_PORT", METRICS_PORT))
+# Последний обработанный update_id: после перезапуска продолжаем с него, ничего не теряя
+UPDATE_OFFSET_PATH = os.getenv("UPDATE_OFFSET_PATH", UPDATE_OFFSET_FILE)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", DRAIN_TIMEOUT))
+# Журнал событий квеста для /stats; у каждого воркера свой
+ANALYTICS_PATH = os.getenv("ANALYTICS_LOG", ANALYTICS_LOG)
+# Принятые фото скачиваются в локальный архив (пустой PHOTO_ARCHIVE_DIR — выключить)
+PHOTO_ARCHIVE_DIR = os.getenv("PHOTO_ARCHIVE_DIR", ARCHIVE_DIR)
+PHOTO_ARCHIVE_WORKERS = int(os.getenv("PHOTO_ARCHIVE_WORKERS", ARCHIVE_WORKERS))
+# Рассылка /broadcast: сообщений в секунду и файлы прогресса и заблокировавших бота
+BROADCAST_MESSAGES_PER_SECOND = float(os.getenv("BROADCAST_RATE", BROADCAST_RATE))
+BROADCAST_STATE_PATH = os.getenv("BROADCAST_STATE_PATH", BROADCAST_STATE_FILE)
+BLOCKED_USERS_PATH = os.getenv("BLOCKED_USERS_PATH", BLOCKED_USERS_FILE)
+# Простой игрока, секунды: выгрузка его FSM из памяти и напоминание о брошенном квесте (0 — не напоминать)
+SESSION_EVICT_AFTER = float(os.getenv("SESSION_EVICT_AFTER", EVICT_AFTER))
+SESSION_REMIND_AFTER = float(os.getenv("REMIND_AFTER", REMIND_AFTER))
+EXPIRY_SWEEP_INTERVAL = 60  # секунды между проверками истёкших доступов
+ID_SEPARATORS = re.compile(r"[\s,;]+")
 
 
 if TOKEN is None:
@@ -23,27 +96,72 @@ if TOKEN is None:
 logging.basicConfig(level=logging.INFO)
 
 # Инициализация бота
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-# Состояния квеста
-class QuestState(StatesGroup):
-    question1 = State()
-    question2 = State()
-    question3 = State()
-    question4 = State()
-    question5 = State()
-    question6 = State()
-    question7 = State()
-    question8 = State()
-    question9 = State()
-    question10 = State()
+if TELEGRAM_API_URL:
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TOKEN)
+bot.session.middleware(ApiMetricsMiddleware())
+if WORKERS > 1:
+    # У каждого воркера свои шарды FSM, каждый шард в отдельном файле
+    worker_index = os.getenv("WORKER_INDEX")
+    owned_shards = (
+        HashRing(WORKERS, SHARD_RING_REPLICAS).shards_of(int(worker_index), SHARD_COUNT)
+        if worker_index is not None else ()
+    )
+    storage = ShardedStorage(FSM_DB, SHARD_COUNT, owned_shards)
+else:
+    storage = SQLiteStorage(FSM_DB)
+dp = Dispatcher(storage=TimedStorage(storage), disable_fsm=True)
+# aiogram закрывает хранилище первым обработчиком shutdown, ещё до дообработки обновлений;
+# закрываем его сами в конце on_shutdown
+dp.shutdown.handlers.clear()
+update_checkpoint = UpdateCheckpoint(UPDATE_OFFSET_PATH)
+if WORKERS == 1:
+    # В многопроцессном режиме отметку ведёт фронт, воркеры дообрабатывают свой stdin
+    dp.update.outer_middleware(update_checkpoint)
+# Фото из альбома приходят отдельными обновлениями — собираем их в одно до загрузки состояния
+media_groups = MediaGroupCollector()
+dp.update.outer_middleware(media_groups)
+dp.update.outer_middleware(ChatScheduler(UPDATES_CONCURRENCY, CHAT_QUEUE_LIMIT))
+# Состояние читается один раз на обновление, изменения пишутся одной записью после обработчика
+dp.update.outer_middleware(TransactionalFSMMiddleware(dp.storage, dp.fsm.events_isolation))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+background_tasks = set()
+metrics_runner = None
+media_cache = MediaCache(MEDIA_CACHE_PATH)
+# Пересылки в админский чат уходят в фоне, игрок не ждёт их
+# Лимит Telegram на админский чат общий для всех процессов: воркеры делят его поровну
+outbound = OutboundQueue(
+    bot, rate_per_minute=ADMIN_CHAT_RATE / WORKERS, burst=max(1, OUTBOUND_BURST // WORKERS),
+    path=worker_log_path(OUTBOUND_JOURNAL_PATH, os.getenv("WORKER_INDEX")) if OUTBOUND_JOURNAL_PATH else None,
+)
+registry.gauge("outbound_queue_depth", lambda: outbound.depth)
+
+analytics = Analytics(ANALYTICS_PATH, worker=os.getenv("WORKER_INDEX"))
+archiver = PhotoArchiver(bot, PHOTO_ARCHIVE_DIR, PHOTO_ARCHIVE_WORKERS) if PHOTO_ARCHIVE_DIR else None
+blocked_users = BlockedUsers(BLOCKED_USERS_PATH)
+broadcaster = Broadcaster(
+    bot, lambda: (user_id for user_id, _ in iter_paid_users()), is_user_paid,
+    state_path=BROADCAST_STATE_PATH, blocked_users=blocked_users, rate=BROADCAST_MESSAGES_PER_SECOND,
+)
+
+# Квесты описаны в quests/*.json и компилируются при запуске
+quest_engine = QuestEngine(outbound, ADMIN_CHAT_ID, analytics, archiver)
+quest_engine.load_dir(QUESTS_PATH)
+dp.include_router(quest_engine.router)
+# Записи FSM молчащих игроков выгружаются из памяти, бросившим квест — напоминание
+sessions = SessionTracker(
+    bot, storage, quest_engine.steps, SESSION_EVICT_AFTER, SESSION_REMIND_AFTER, blocked_users=blocked_users,
+)
+dp.update.outer_middleware(sessions)
 
 # Приветственное сообщение с фото
 @dp.message(Command("start"))
-async def send_welcome(message: types.Message, state: FSMContext):
+async def send_welcome(message: types.Message, state: FSMContext, command: CommandObject):
     user_id = message.from_user.id
+    # Игрок снова пишет боту — значит, разблокировал его
+    blocked_users.discard(user_id)
 
     if not is_user_paid(user_id):
         await message.answer(
@@ -60,14 +178,17 @@ async def send_welcome(message: types.Message, state: FSMContext):
         )
         return
 
-    photo = FSInputFile(WELCOME_IMAGE_PATH)
-    await message.answer_photo(photo, caption=
-        "👋 Добро пожаловать в Subotica Quest!\n\n"
-        "Этот квест сделает твою прогулку по Суботице увлекательнее.\n"
-        "Прояви креативность и главное — наслаждайся процессом!\n\n"
-        "Готов начать? Тогда вперед! 🚀"
-    )
-    await ask_question1(message, state)
+    # /start <id квеста> — например, из ссылки t.me/<бот>?start=<id квеста>
+    quest = quest_engine.get_quest(command.args)
+    if quest is None:
+        await message.answer("❌ Такого квеста нет.")
+        return
+
+    if quest.welcome_caption:
+        await media_cache.send_photo(
+            message, quest.welcome_image or WELCOME_IMAGE_PATH, caption=quest.welcome_caption
+        )
+    await quest_engine.start(message, state, quest)
 
 
 @dp.message(Command("id"))
@@ -77,368 +198,320 @@ async def send_user_id(message: types.Message):
     await message.answer(f"📌 Ваш Telegram ID: `{user_id}`", parse_mode="Markdown")
 
 
+def parse_expiry(value):
+    """
+    Разбирает срок доступа: "30d"/"30д" (дней от текущего момента),
+    дата или дата-время ISO ("2025-12-31", "2025-12-31T18:00:00+00:00")
+    или unix-время. Пустое значение — бессрочно. Иначе ValueError.
+    """
+    value = value.strip()
+    if not value:
+        return None
+    if value[-1] in ("d", "д") and value[:-1].isdigit():
+        return int(time.time()) + int(value[:-1]) * 86400
+    if value.isdigit():
+        return int(value)
+    expires = datetime.fromisoformat(value)
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return int(expires.timestamp())
+
+
+def format_expiry(expires_at):
+    return datetime.fromtimestamp(expires_at, timezone.utc).isoformat(timespec="seconds")
+
+
+def parse_command_ids(text):
+    """Разбирает аргументы /add и /remove: id через пробел или запятую и необязательный срок."""
+    user_ids, expires_at, invalid = [], None, []
+    for token in ID_SEPARATORS.split(text)[1:]:
+        if not token:
+            continue
+        try:
+            user_ids.append(int(token))
+            continue
+        except ValueError:
+            pass
+        try:
+            expires_at = parse_expiry(token)
+        except ValueError:
+            invalid.append(token)
+    return [(user_id, expires_at) for user_id in user_ids], invalid
+
+
+def parse_document_ids(filename, content):
+    """
+    Разбирает загруженный файл со списком пользователей.
+
+    CSV: первая колонка — id, вторая (необязательная) — срок доступа;
+    строка заголовка пропускается. JSON: список id или объектов
+    {"user_id": ..., "expires_at": ...}, либо такой список в {"users": [...]}.
+    """
+    text = content.decode("utf-8-sig")
+    entries, invalid = [], []
+    if filename.lower().endswith(".json"):
+        items = json.loads(text)
+        if isinstance(items, dict):
+            items = items.get("users", [])
+        if not isinstance(items, list):
+            return [], [filename]
+        for item in items:
+            try:
+                if isinstance(item, dict):
+                    expires_at = item.get("expires_at")
+                    entries.append((int(item["user_id"]), parse_expiry(str(expires_at or ""))))
+                else:
+                    entries.append((int(item), None))
+            except (KeyError, ValueError, TypeError):
+                invalid.append(str(item))
+        return entries, invalid
+
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not row[0].strip():
+            continue
+        try:
+            user_id = int(row[0])
+        except ValueError:
+            if not entries and not invalid:
+                continue  # заголовок
+            invalid.append(row[0])
+            continue
+        try:
+            entries.append((user_id, parse_expiry(row[1] if len(row) > 1 else "")))
+        except ValueError:
+            invalid.append(",".join(row))
+    return entries, invalid
+
+
+async def read_entries(message: types.Message, command: str):
+    """Собирает пары (id, срок) из текста команды или из приложенного файла."""
+    if message.document:
+        file = await bot.download(message.document)
+        try:
+            return parse_document_ids(message.document.file_name or "", file.read())
+        except (UnicodeDecodeError, json.JSONDecodeError, csv.Error):
+            return [], [message.document.file_name or command]
+    return parse_command_ids(message.text or message.caption or "")
+
+
 @dp.message(Command("add"))
 async def add_user_command(message: types.Message):
-    """Добавление пользователя в список оплативших (только для админа)"""
+    """Добавление пользователей в список оплативших (только для админа)"""
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ У вас нет прав на добавление пользователей.")
         return
 
-    args = message.text.split()
-    if len(args) < 2:
-        await message.answer("❌ Введите ID пользователя после /add")
+    entries, invalid = await read_entries(message, "/add")
+    if invalid:
+        await message.answer("❌ ID должен быть числом. Не удалось разобрать: " + ", ".join(invalid[:20]))
+        return
+    if not entries:
+        await message.answer(
+            "❌ Введите ID пользователя после /add\n"
+            "Можно несколько через пробел и срок доступа в конце (30d или 2025-12-31),\n"
+            "либо пришлите CSV/JSON-файл с подписью /add"
+        )
         return
 
-    try:
-        user_id = int(args[1])
-        add_user(user_id)
-        await message.answer(f"✅ Пользователь {user_id} добавлен в список оплативших.")
-    except ValueError:
-        await message.answer("❌ ID должен быть числом.")
+    add_users_with_expiry(entries)
+    if len(entries) == 1:
+        user_id, expires_at = entries[0]
+        text = f"✅ Пользователь {user_id} добавлен в список оплативших."
+    else:
+        expires_at = entries[0][1] if len({entry[1] for entry in entries}) == 1 else None
+        text = f"✅ Добавлено в список оплативших: {len(entries)}."
+    if expires_at is not None:
+        text += f"\n⏳ Доступ до {format_expiry(expires_at)}"
+    await message.answer(text)
 
 @dp.message(Command("remove"))
 async def remove_user_command(message: types.Message):
-    """Удаление пользователя из списка оплативших (только для админа)"""
+    """Удаление пользователей из списка оплативших (только для админа)"""
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ У вас нет прав на удаление пользователей.")
         return
 
-    args = message.text.split()
-    if len(args) < 2:
-        await message.answer("❌ Введите ID пользователя после /remove")
+    entries, invalid = await read_entries(message, "/remove")
+    if invalid:
+        await message.answer("❌ ID должен быть числом. Не удалось разобрать: " + ", ".join(invalid[:20]))
         return
-
-    try:
-        user_id = int(args[1])
-        remove_user(user_id)
-        await message.answer(f"✅ Пользователь {user_id} удалён из списка оплативших.")
-    except ValueError:
-        await message.answer("❌ ID должен быть числом.")
-# Функция для создания клавиатуры викторины
-def get_quiz_keyboard(options):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=opt, callback_data=opt)] for opt in options
-    ])
-
-
-# Вопрос 1 (логика исправлена, чтобы правильно учитывать попытки)
-async def ask_question1(message: types.Message, state: FSMContext):
-    await message.answer(
-        "🦇 Задание 1\n"
-        "У вокзала, где улица дышит тишиной,\n"
-        "Крылатая стража нашла угол свой.\n"
-        "Найди её облик на каменной глади —\n"
-        "А сколько ступенек ведут к её „зграде“?"
-    )
-    await state.update_data(attempts=0)
-    await state.set_state(QuestState.question1)
-
-@dp.message(QuestState.question1)
-async def process_question1(message: types.Message, state: FSMContext):
-    if message.photo:
-        await message.answer("❌ Это не фото-задание! Пожалуйста, напиши ответ.")
+    if not entries:
+        await message.answer("❌ Введите ID пользователя после /remove")
         return
 
-    data = await state.get_data()
-    attempts = data.get("attempts", 0)
-
-    if message.text.strip() == "7":
-        await message.answer("✅ Правильно! Двигаемся дальше!")
-        await ask_question2(message, state)
+    remove_users([user_id for user_id, _ in entries])
+    if len(entries) == 1:
+        await message.answer(f"✅ Пользователь {entries[0][0]} удалён из списка оплативших.")
     else:
-        attempts += 1
-        await state.update_data(attempts=attempts)
-        if attempts < 3:
-            await message.answer(f"❌ Не совсем. Посчитай ещё раз! Осталось попыток: {3 - attempts}")
-        else:
-            await message.answer("❌ К сожалению, неверно! Правильный ответ: 7. Двигаемся дальше!")
-            await ask_question2(message, state)
-
-# Вопрос 2 (фото)
-async def ask_question2(message: types.Message, state: FSMContext):
-    await message.answer("🩷  Задание 2\n"
-        "В фасадах и плитке, в кованых узорах\n"
-        "Скрываются сердца в городских просторах.\n"
-        "Найди их на зданиях — три отыщи,\n"
-        "Выбери снимки и мне отошли!")
-    await state.set_state(QuestState.question2)
-    await state.update_data(photo_count=0)
-
-@dp.message(QuestState.question2, F.photo)
-async def process_question2(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    photo_count = data.get("photo_count", 0) + 1
-
-    if photo_count > 3:
-        await message.answer("⚠️ Достаточно 3 фото! Но мне приятно видеть, как ты стараешься.")
-        return
+        await message.answer(f"✅ Удалено из списка оплативших: {len(entries)}.")
 
-    await state.update_data(photo_count=photo_count)
-    await bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
 
-    if photo_count < 3:
-        await message.answer(f"📸 Фото {photo_count}/3 принято! Жду ещё {3 - photo_count}.")
-    else:
-        await bot.send_message(ADMIN_CHAT_ID, f"📷 Пользователь @{message.from_user.username} отправил 3 фото для задания 2")
-        await message.answer("✅ Отличная коллекция вышла! 🩷 Следующее задание!")
-        await ask_question3(message, state)
-        await state.update_data(photo_count=0)
-
-@dp.message(QuestState.question2)
-async def handle_text_in_question2(message: types.Message):
-    await message.answer("❌ Ты удивишься, как часто в архитектуре встречаются сердечки! Пришли три разные фотографии")
-
-# Вопрос 3 (текстовый ответ)
-async def ask_question3(message: types.Message, state: FSMContext):
-    await message.answer(
-        "📖 Задание 3\n"
-        "В книжный зайди, отыщи без труда\n"
-        "Книгу, что в сердце твоём навсегда.\n"
-        "Название новое вслух прочитай —\n"
-        "Как на сербском звучит, отвечай!"
-    )
-    await state.set_state(QuestState.question3)
-
-@dp.message(QuestState.question3)
-async def process_question3(message: types.Message, state: FSMContext):
-    await message.answer("📚 Интересный выбор любимой книги! Идем дальше?")
-    await ask_question4(message, state)
-
-# Вопрос 4 (фото двери)
-async def ask_question4(message: types.Message, state: FSMContext):
-    await message.answer(
-        "🚪 Задание 4\n"
-        "Найди любую открытую дверь,\n"
-        "Внутрь загляни, тишине лишь поверь.\n"
-        "Лестницы стройной изгибы узри\n"
-        "И фото двери мне скорее пришли!"
-    )
-    await state.update_data(photo_count=0)
-    await state.set_state(QuestState.question4)
+def write_export(path):
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["user_id", "expires_at"])
+        for user_id, expires_at in iter_paid_users():
+            writer.writerow([user_id, format_expiry(expires_at) if expires_at else ""])
 
-@dp.message(QuestState.question4, F.photo)
-async def process_question4(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    photo_count = data.get("photo_count", 0) + 1
 
-    if photo_count > 1:
-        await message.answer("⚠️ Одного фото мне хватит, спасибо!")
+@dp.message(Command("export"))
+async def export_users_command(message: types.Message):
+    """Выгрузка списка оплативших в CSV (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав на выгрузку пользователей.")
         return
 
-    await state.update_data(photo_count=photo_count)
-    await bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
-
-    await bot.send_message(ADMIN_CHAT_ID, f"📷 Пользователь @{message.from_user.username} отправил фото для задания 4")
-    await message.answer("✅ Отличное фото вышло! Следующее задание!")
-    await ask_question5(message, state)
-    await state.update_data(photo_count=1)
-
-@dp.message(QuestState.question4)
-async def handle_text_in_question4(message: types.Message):
-    await message.answer("❌ Мне бы хотелось увидеть твою фотографию двери! Какую удалось найти?")
-
-# Вопрос 5 (логика исправлена, чтобы правильно учитывать попытки)
-async def ask_question5(message: types.Message, state: FSMContext):
-    await message.answer(
-        "🏛 Задание 5\n"
-        "В центре Суботицы, где жизни быстрый ход,\n"
-        "Миниатюра города тихо живёт.\n"
-        "Вглядись, рассмотри, все детали узнай,\n"
-        "Из чего он создан — скорей отгадай!"
-    )
-    await state.update_data(attempts=0)
-    await state.set_state(QuestState.question5)
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        await asyncio.to_thread(write_export, path)
+        await message.answer_document(FSInputFile(path, filename="paid_users.csv"))
+    finally:
+        os.remove(path)
 
-@dp.message(QuestState.question5)
-async def process_question5(message: types.Message, state: FSMContext):
-    if message.photo:
-        await message.answer("❌ Это не фото-задание! Пожалуйста, напиши свой ответ.")
+
+@dp.message(Command("perf"))
+async def perf_command(message: types.Message):
+    """Сводка по задержкам обработчиков и Bot API (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав на просмотр метрик.")
         return
 
-    data = await state.get_data()
-    attempts = data.get("attempts", 0)
+    await message.answer(format_summary())
 
-    if message.text.strip().lower() == "бронза":
-        await message.answer("✅ Ура! Это правильный ответ. Двигаемся дальше!")
-        await ask_question6(message, state)
-    else:
-        attempts += 1
-        await state.update_data(attempts=attempts)
-        if attempts < 3:
-            await message.answer(f"❌ Не совсем. Подумай ещё! Осталось попыток: {3 - attempts}")
-        else:
-            await message.answer("❌ Неверно! Правильный ответ: Бронза. В следующий раз повезёт!")
-            await ask_question6(message, state)
-
-        # Вопрос 6 (прием фото, строго 1 фото)
-async def ask_question6(message: types.Message, state: FSMContext):
-    await message.answer(
-        "⛲️ Задание 6\n"
-        "Два архитектора и 'magnum opus' рядом —\n"
-        "Полны любовью, вдохновением их взгляды.\n"
-        "Когда найдешь их - время не теряй\n"
-        "Используй камеру и фото отправляй!"
-    )
-    await state.update_data(photo_count=0)
-    await state.set_state(QuestState.question6)
 
-@dp.message(QuestState.question6, F.photo)
-async def process_question6(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    photo_count = data.get("photo_count", 0) + 1
-
-    if photo_count > 1:
-        await message.answer("⚠️ Одной фотографии достаточно.")
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message):
+    """Воронка квестов, попытки на вопросах и время этапов (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав на просмотр статистики.")
         return
 
-    await state.update_data(photo_count=photo_count)
-    await bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
-
-    await bot.send_message(ADMIN_CHAT_ID, f"📷 Пользователь @{message.from_user.username} отправил фото для задания 6")
-    await message.answer("✅ Молодец! В следующем задании тебя ждет приятная миссия!")
-    await ask_question7(message, state)
-    await state.update_data(photo_count=1)
-
-@dp.message(QuestState.question6)
-async def handle_text_in_question6(message: types.Message):
-    await message.answer("❌ Я бы хотела увидеть фотографию архитекторов! Пожалуйста, отправь один снимок.")
-
-# Вопрос 7 (логика исправлена, чтобы правильно учитывать попытки)
-async def ask_question7(message: types.Message, state: FSMContext):
-    await message.answer(
-        "🧘‍♂️ Задание 7\n"
-        "Метание духа оставь позади\n"
-        "Единство суеты и тишины в груди\n"
-        "Расслабься, где кофе, уют и покой\n"
-        "А радость была ведь всегда под рукой\n"
-        "Когда все поймешь - ответ ты найдешь!"
-    )
-    await state.update_data(attempts=0)
-    await state.set_state(QuestState.question7)
+    await message.answer(format_stats(analytics.combined_stats(), quest_engine.quests.values()))
+
 
-@dp.message(QuestState.question7)
-async def process_question7(message: types.Message, state: FSMContext):
-    if message.photo:
-        await message.answer("❌ Это не фото-задание! Ощути момент и пришли ответ.")
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    """Рассылка всем оплатившим (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет прав на рассылку.")
         return
 
-    data = await state.get_data()
-    attempts = data.get("attempts", 0)
+    if command.args == "stop":
+        if not await broadcaster.cancel():
+            await message.answer("❌ Рассылка не идёт.")
+        return
+    if broadcaster.running:
+        await message.answer("❌ Рассылка уже идёт. Остановить: /broadcast stop")
+        return
 
-    if message.text.strip().lower() == "мерак":
-        await message.answer("✅ Именно так! Надеюсь тебе удалось насладиться моментом и отдохнуть!")
-        await ask_question8(message, state)
+    if message.reply_to_message is not None:
+        # Ответом на сообщение рассылается его копия — с фото, форматированием и т.д.
+        content = {"from_chat_id": message.chat.id, "message_id": message.reply_to_message.message_id}
+    elif command.args:
+        content = {"text": command.args}
     else:
-        attempts += 1
-        await state.update_data(attempts=attempts)
-        if attempts < 3:
-            await message.answer(f"❌ Ты точно пьешь напиток и ощущаешь это состояние? Попробуйте ещё раз посмотреть внимательнее на задание! Осталось попыток: {3 - attempts}")
-        else:
-            await message.answer("❌ Мне жаль! Правильный ответ: Мерак. Отгадка крылась в первых буквах. Постарайся дальше быть внимательнее!")
-            await ask_question8(message, state)
-
-# Вопрос 8 (логика исправлена, чтобы правильно учитывать попытки)
-async def ask_question8(message: types.Message, state: FSMContext):
-    await message.answer(
-        "📍 Задание 8\n"
-        "Там, где камень лежит вековой под ногой,\n"
-        "Начинает улицу магазин обувной.\n"
-        "Мощёная, древняя, манит пройтись\n"
-        "Названье пиши и на ней окажись."
-    )
-    await state.update_data(attempts=0)
-    await state.set_state(QuestState.question8)
-
-@dp.message(QuestState.question8)
-async def process_question8(message: types.Message, state: FSMContext):
-    if message.photo:
-        await message.answer("❌ Это не фото-задание! Угадай название улицы.")
+        await message.answer(
+            "❌ Введите текст после /broadcast или отправьте /broadcast ответом на сообщение для рассылки.\n"
+            "Остановить рассылку: /broadcast stop"
+        )
         return
+    broadcaster.start(message.chat.id, content)
 
-    data = await state.get_data()
-    attempts = data.get("attempts", 0)
 
-    if message.text.strip().lower() == "петра драпшина":
-        await message.answer("✅ Совершенно верно! Понравилась улочка?")
-        await ask_question9(message, state)
-    else:
-        attempts += 1
-        await state.update_data(attempts=attempts)
-        if attempts < 3:
-            await message.answer(f"❌ Не правильно.  Найди мощёную улицу рядом с круговым перекрестком! Осталось попыток: {3 - attempts}")
-        else:
-            await message.answer("❌ Неверно! Правильный ответ: Петра Драпшина. Советую найти эту улочку и прогуляться по ней!")
-            await ask_question9(message, state)
-
-# Вопрос 9 (логика исправлена, чтобы правильно учитывать попытки)
-async def ask_question9(message: types.Message, state: FSMContext):
-    await message.answer(
-        "🥞 Задание 9\n"
-        "В Суботице, где вкусно и тепло,\n"
-        "Лепешка жарится, пахнет — просто волшебство.\n"
-        "Венгерская, с хрустящей корочкой, она,\n"
-        "Назови её имя — и загадка решена."
-    )
-    await state.update_data(attempts=0)
-    await state.set_state(QuestState.question9)
-
-@dp.message(QuestState.question9)
-async def process_question9(message: types.Message, state: FSMContext):
-    if message.photo:
-        await message.answer("❌ Это не фото-задание! Пожалуйста, напиши название лепёшки.")
-        return
+async def sweep_expired_periodically():
+    while True:
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+        expired = sweep_expired_users()
+        if expired:
+            logging.info("Истёк доступ у пользователей: %s", expired)
 
-    data = await state.get_data()
-    attempts = data.get("attempts", 0)
 
-    if message.text.strip().lower() == "лангош":
-        await message.answer("✅ Совершенно верно! Думаю, стоит попробовать, пока ты здесь!")
-        await ask_question10(message, state)
-    else:
-        attempts += 1
-        await state.update_data(attempts=attempts)
-        if attempts < 3:
-            await message.answer(f"❌ Пока не угадал. Про нее я писала в путеводите. Можешь поискать подсказку там. Осталось попыток: {3 - attempts}")
-        else:
-            await message.answer("❌ К сожалению, неверно! Правильный ответ: Лангош. Не переживай. Впереди последнее задание, оно творческое и проигравших не будет!")
-            await ask_question10(message, state)
-
-# Вопрос 10 (фото + Instagram)
-async def ask_question10(message: types.Message, state: FSMContext):
-    await message.answer(
-        "📸 Задание 10\n"
-        "Сними тот миг, что в сердце отзовётся,\n"
-        "Где город нежно дарит свой привет.\n"
-        "Пусть в кадре атмосфера остаётся,\n"
-        "Такой, какой запомнишь ты навек."
-    )
-    await state.update_data(photo_received=False)
-    await state.set_state(QuestState.question10)
-
-@dp.message(QuestState.question10, F.photo)
-async def process_question10(message: types.Message, state: FSMContext):
-    # Принимаем фото
-    await bot.send_message(ADMIN_CHAT_ID, f"📷 Пользователь @{message.from_user.username} отправил фото для задания 10")
-    await bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
-
-    await message.answer(
-        "✅ Замечательный снимок Суботицы!\n"
-        "\n"
-        "✨ Буду рада, если ты подпишешься на меня в Instagram: https://www.instagram.com/hristy_life\n"
-        "📸 Если захочешь, поделись этим фото в сторис и отметь меня — с удовольствием сделаю репост,"
-        "и расскажу про маленький сюрприз для тех, кто дошёл до конца. 🎁\n"
-        "\n"
-        "💖 Спасибо за участие в квесте! Надеюсь, тебе понравилось. До новых встреч!"
+@dp.startup()
+async def on_startup():
+    global metrics_runner
+    # Список оплативших и квесты загружены при импорте; осталось посчитать хэши картинок
+    media_cache.warm(
+        {WELCOME_IMAGE_PATH} | {quest.welcome_image for quest in quest_engine.quests.values() if quest.welcome_image}
     )
-    await state.clear()
-
-@dp.message(QuestState.question10)
-async def handle_text_in_question10(message: types.Message):
-    await message.answer("❌ Сделай фото, которое, по твоему мнению, передаёт атмосферу Суботицы.")
+    # Пересылки, не отправленные до перезапуска, встают в очередь первыми
+    outbound.load()
+    background_tasks.add(asyncio.create_task(update_checkpoint.run()))
+    background_tasks.add(asyncio.create_task(analytics.run()))
+    background_tasks.add(asyncio.create_task(sessions.run()))
+    if PAID_USERS_WRITER:
+        background_tasks.add(asyncio.create_task(sweep_expired_periodically()))
+        # Рассылка, прерванная перезапуском, продолжается с места остановки
+        broadcaster.resume()
+    # Правки paid_users.json и журнала со стороны подхватываются без перезапуска;
+    # kill -USR1 <pid> — перечитать сразу
+    background_tasks.add(asyncio.create_task(watch_paid_users()))
+    with suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, invalidate_paid_users)
+    if METRICS_LISTEN_PORT:
+        port = METRICS_LISTEN_PORT + int(os.getenv("WORKER_INDEX", -1)) + 1
+        try:
+            metrics_runner = await start_metrics_server(host=METRICS_LISTEN_HOST, port=port)
+        except OSError as e:
+            logging.error("Не удалось открыть порт метрик %s: %s", port, e)
+    update_checkpoint.ready()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    # Новые обновления уже не принимаются. Всё укладывается в SHUTDOWN_DRAIN_TIMEOUT (дальше SIGKILL):
+    # сначала дообрабатываем начатые обновления и сразу сохраняем отметку и FSM,
+    # затем очереди дожидаются оставшимся временем — общим для всех
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_DRAIN_TIMEOUT
+    await update_checkpoint.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    await media_groups.close()
+    await update_checkpoint.save()
+    await storage.flush()
+    remaining = max(0.0, deadline - loop.time())
+    closing = [outbound.close(remaining), broadcaster.close(remaining)]
+    if archiver is not None:
+        closing.append(archiver.close(remaining))
+    await asyncio.gather(*closing)
+    for task in background_tasks:
+        task.cancel()
+    analytics.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await dp.fsm.close()
 
 
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
+    if WORKERS > 1:
+        pool = WorkerPool(WORKERS, ADMIN_ID, shards=SHARD_COUNT, replicas=SHARD_RING_REPLICAS)
+        allowed_updates = dp.resolve_used_update_types()
+        if WEBHOOK_URL:
+            await run_webhook_front(
+                bot, pool, WEBHOOK_URL,
+                path=WEBHOOK_LISTEN_PATH,
+                secret=WEBHOOK_SECRET,
+                host=WEB_LISTEN_HOST,
+                port=WEB_LISTEN_PORT,
+                allowed_updates=allowed_updates,
+                checkpoint=update_checkpoint,
+            )
+        else:
+            await bot.delete_webhook()
+            await run_polling_front(bot, pool, allowed_updates=allowed_updates, checkpoint=update_checkpoint)
+        return
+
+    if WEBHOOK_URL:
+        await run_webhook(
+            dp, bot, WEBHOOK_URL,
+            path=WEBHOOK_LISTEN_PATH,
+            secret=WEBHOOK_SECRET,
+            host=WEB_LISTEN_HOST,
+            port=WEB_LISTEN_PORT,
+        )
+        return
+
+    # Обновления, пришедшие во время перезапуска, не выбрасываем
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from metrics import registry
+from outbound import TokenBucket, MAX_BACKOFF
+
+BROADCAST_RATE = 25  # сообщений в секунду: общий лимит Telegram ~30, остальное — ответам игрокам
+BROADCAST_BURST = 5
+BROADCAST_CONCURRENCY = 8  # одновременных запросов, чтобы задержка API не ограничивала скорость
+BROADCAST_STATE_FILE = "broadcast.json"
+BLOCKED_USERS_FILE = "blocked_users.txt"
+CHECKPOINT_INTERVAL = 1  # секунды между сохранениями прогресса
+PROGRESS_INTERVAL = 5  # секунды между обновлениями сообщения о прогрессе
+SEND_ATTEMPTS = 5
+STOP_TIMEOUT = 5  # секунды на завершение начатых отправок при остановке бота
+
+logger = logging.getLogger(__name__)
+registry.describe("broadcast_sent_total", "Сообщения рассылки, доставленные игрокам")
+registry.describe("broadcast_failed_total", "Сообщения рассылки, которые не удалось доставить")
+registry.describe("broadcast_blocked_total", "Игроки, заблокировавшие бота (найдены при рассылке)")
+
+
+def _write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _format_eta(seconds):
+    if seconds < 90:
+        return f"{seconds:.0f} с"
+    if seconds < 5400:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+class BlockedUsers:
+    """
+    Игроки, заблокировавшие бота; рассылка их пропускает.
+
+    Файл только дописывается: строка "id" — заблокировал, "-id" — снова
+    написал боту (discard()). Дописывать могут все воркеры, а refresh()
+    перечитывает файл, если он изменился.
+    """
+
+    def __init__(self, path=BLOCKED_USERS_FILE):
+        self.path = path
+        self._users = set()
+        self._file_id = None
+        self.refresh()
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_size, stat.st_mtime_ns) == self._file_id:
+            return
+        self._file_id = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        users = set()
+        with open(self.path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if line.startswith("-"):
+                    users.discard(int(line[1:]))
+                elif line:
+                    users.add(int(line))
+        self._users = users
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def _append(self, line):
+        with open(self.path, "a") as file:
+            file.write(line + "\n")
+
+    def add(self, user_id):
+        if user_id not in self._users:
+            self._users.add(user_id)
+            self._append(str(user_id))
+
+    def discard(self, user_id):
+        self.refresh()
+        if user_id in self._users:
+            self._users.discard(user_id)
+            self._append(f"-{user_id}")
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения всем оплатившим с общим ограничением скорости.
+
+    Получатели идут по возрастанию id (iter_paid_users отдаёт их
+    отсортированными) и перебираются по ходу рассылки; сколько их всего,
+    считается в отдельном потоке, пока идут первые отправки.
+    Отправляют concurrency задач через один TokenBucket
+    на rate сообщений в секунду. RetryAfter останавливает весь bucket,
+    сетевые ошибки повторяются с паузой.
+
+    Прогресс — id, до которого включительно всё отправлено (запросы
+    завершаются не по порядку, поэтому это id перед самым ранним
+    незавершённым), — раз в секунду сохраняется в broadcast.json. После
+    падения или перезапуска resume() продолжает с него; повторно могут
+    получить сообщение только те, чьи запросы были в работе.
+
+    Заблокировавшие бота записываются в BlockedUsers и больше не получают
+    рассылок. Админу раз в PROGRESS_INTERVAL секунд обновляется одно
+    сообщение с прогрессом и оценкой оставшегося времени.
+    """
+
+    def __init__(self, bot: Bot, recipients, is_recipient, state_path=BROADCAST_STATE_FILE,
+                 blocked_users=None, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 registry=registry):
+        self.bot = bot
+        self.recipients = recipients
+        self.is_recipient = is_recipient
+        self.state_path = state_path
+        self.blocked_users = blocked_users if blocked_users is not None else BlockedUsers()
+        self.rate = rate
+        self.concurrency = concurrency
+        self.state = None
+        self._task = None
+        self._stopping = False
+        self._resumed_at = None
+        self._resumed_done = 0
+        self._registry = registry
+        registry.gauge("broadcast_running", lambda: int(self.running))
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def _pending(self, after=None):
+        """Id получателей по возрастанию, начиная после after."""
+        for user_id in self.recipients():
+            if after is not None and user_id <= after:
+                continue
+            if user_id in self.blocked_users or not self.is_recipient(user_id):
+                continue
+            yield user_id
+
+    def start(self, admin_chat_id, message):
+        """
+        Запускает рассылку. message — {"text": ...} или {"from_chat_id": ..., "message_id": ...}
+        (копия сообщения админа). Возвращает False, если рассылка уже идёт.
+        """
+        if self.running:
+            return False
+        self.blocked_users.refresh()
+        self.state = {
+            "message": message,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": None,
+            "cursor": None,
+            "total": None,  # посчитает _run()
+            "done": 0,
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "started_at": time.time(),
+        }
+        self._save()
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    def resume(self):
+        """Продолжает рассылку, прерванную остановкой или падением. True — было что продолжить."""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as file:
+                self.state = json.load(file)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            logger.error("Состояние рассылки %s повреждено: %s", self.state_path, e)
+            return False
+        logger.info("Продолжаем рассылку после id %s", self.state["cursor"])
+        self._task = asyncio.create_task(self._run(resumed=True))
+        return True
+
+    async def cancel(self):
+        """Останавливает рассылку по команде админа; продолжать её не будем."""
+        if not self.running:
+            return False
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        state = self.state
+        self._finish()
+        await self._report(state, "⛔ Рассылка остановлена")
+        return True
+
+    async def close(self, timeout=STOP_TIMEOUT):
+        """
+        Останавливает рассылку при остановке бота, сохранив прогресс для resume():
+        новые отправки не начинаются, начатые дожидаются (не дольше timeout).
+        """
+        if not self.running:
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            logger.error("Рассылка не успела остановиться, незавершённые отправки повторятся после перезапуска")
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _save(self):
+        try:
+            _write_json(self.state_path, self.state)
+        except OSError as e:
+            logger.error("Не удалось сохранить прогресс рассылки: %s", e)
+
+    def _finish(self):
+        self.state = None
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def progress_text(self, state, title):
+        elapsed = time.monotonic() - self._resumed_at if self._resumed_at is not None else 0
+        speed = (state["done"] - self._resumed_done) / elapsed if elapsed > 0 else 0
+        if state["total"] is None:
+            # Получателей ещё считают
+            return (
+                f"{title}: {state['done']}\n"
+                f"Доставлено: {state['sent']}, ошибок: {state['failed']}, заблокировали бота: {state['blocked']}"
+            )
+        total = max(state["total"], state["done"])
+        text = (
+            f"{title}: {state['done']}/{total} ({state['done'] * 100 // max(total, 1)}%)\n"
+            f"Доставлено: {state['sent']}, ошибок: {state['failed']}, заблокировали бота: {state['blocked']}"
+        )
+        if speed and state["done"] < total:
+            text += f"\n≈ {speed:.0f} сообщений/с, осталось {_format_eta((total - state['done']) / speed)}"
+        return text
+
+    async def _report(self, state, title):
+        """Обновляет (или отправляет) админу сообщение с прогрессом."""
+        text = self.progress_text(state, title)
+        try:
+            if state["progress_message_id"] is None:
+                sent = await self.bot.send_message(state["admin_chat_id"], text)
+                state["progress_message_id"] = sent.message_id
+            else:
+                await self.bot.edit_message_text(
+                    text, chat_id=state["admin_chat_id"], message_id=state["progress_message_id"]
+                )
+        except TelegramAPIError as e:
+            # Например, "message is not modified" — прогресс не важнее самой рассылки
+            logger.warning("Не удалось обновить прогресс рассылки: %s", e)
+
+    async def _run(self, resumed=False):
+        state = self.state
+        self._resumed_at = time.monotonic()
+        self._resumed_done = state["done"]
+        self.blocked_users.refresh()
+        bucket = TokenBucket(self.rate, BROADCAST_BURST)
+        slots = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+        tasks = set()
+        last_dispatched = state["cursor"]
+
+        def advance():
+            # Всё до самого раннего незавершённого отправлено
+            state["cursor"] = min(in_flight) - 1 if in_flight else last_dispatched
+
+        async def send(user_id):
+            try:
+                await self._deliver(bucket, state, user_id)
+            finally:
+                slots.release()
+            # Отменённая при остановке отправка остаётся незавершённой: отметка её не проходит
+            in_flight.discard(user_id)
+            state["done"] += 1
+            advance()
+
+        async def checkpoint():
+            last_report = time.monotonic()
+            while True:
+                await asyncio.sleep(CHECKPOINT_INTERVAL)
+                self._save()
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(state, "📣 Рассылка")
+
+        async def count():
+            state["total"] = await asyncio.to_thread(lambda: sum(1 for _ in self._pending()))
+
+        # Список сортируется при первом переборе после пересборки, а подсчёт проходит его целиком —
+        # и то и другое в потоке, чтобы не задерживать обработку обновлений
+        await asyncio.to_thread(lambda: next(iter(self.recipients()), None))
+        counter = asyncio.create_task(count()) if state["total"] is None else None
+        await self._report(state, "📣 Рассылка продолжается после перезапуска" if resumed else "📣 Рассылка")
+        saver = asyncio.create_task(checkpoint())
+        try:
+            for user_id in self._pending(state["cursor"]):
+                await slots.acquire()
+                if self._stopping:
+                    slots.release()
+                    break
+                in_flight.add(user_id)
+                last_dispatched = user_id
+                task = asyncio.create_task(send(user_id))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+            advance()
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.state is state:
+                self._save()
+            raise
+        finally:
+            saver.cancel()
+            if counter is not None:
+                counter.cancel()
+
+        if self._stopping:
+            self._save()
+            logger.info("Рассылка остановлена после id %s, продолжится после перезапуска", state["cursor"])
+            return
+        if state["total"] is None:
+            # Разослали быстрее, чем досчитали
+            state["total"] = state["done"]
+        self._finish()
+        await self._report(state, "✅ Рассылка завершена")
+        logger.info("Рассылка завершена: доставлено %d, ошибок %d", state["sent"], state["failed"])
+
+    async def _deliver(self, bucket, state, user_id):
+        message = state["message"]
+        delay = 1
+        for _ in range(SEND_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                if "text" in message:
+                    await self.bot.send_message(user_id, message["text"])
+                else:
+                    await self.bot.copy_message(user_id, message["from_chat_id"], message["message_id"])
+            except TelegramRetryAfter as e:
+                logger.warning("RetryAfter %s с при рассылке", e.retry_after)
+                bucket.pause(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                # Бот заблокирован или аккаунт удалён — больше не пишем
+                self.blocked_users.add(user_id)
+                state["blocked"] += 1
+                self._registry.inc("broadcast_blocked_total")
+                return
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning("Ошибка рассылки игроку %s, повтор через %s с: %s", user_id, delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+                continue
+            except TelegramAPIError as e:
+                logger.warning("Не удалось отправить рассылку игроку %s: %s", user_id, e)
+                break
+            state["sent"] += 1
+            self._registry.inc("broadcast_sent_total")
+            return
+        state["failed"] += 1
+        self._registry.inc("broadcast_failed_total")
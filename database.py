@@ -1,33 +1,498 @@
+import asyncio
+import heapq
 import json
+import logging
+import os
+import time
+from contextlib import suppress
+
+from metrics import registry
 
 PAID_USERS_FILE = "paid_users.json"
+PAID_USERS_JOURNAL = "paid_users.journal"
+COMPACT_THRESHOLD = 10000  # сколько записей журнала копим до пересборки снимка
+MERGE_THRESHOLD = 1000  # сколько изменений держим поверх неизменяемого множества до его пересборки
+WATCH_INTERVAL = 1  # секунды между проверками файлов списка
 
-def load_paid_users():
-    """Загружает список оплативших пользователей из JSON-файла."""
+_REMOVED = object()
+_MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+def _fsync_dir(path):
+    """Сбрасывает на диск запись каталога (нужно после os.replace)."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _parse(line):
+    """Запись журнала -> (id, срок доступа или None, либо _REMOVED для удаления)."""
+    op, fields = line[0], line[1:].split()
+    user_id = int(fields[0])
+    if op == "-":
+        return user_id, _REMOVED
+    return user_id, int(fields[1]) if len(fields) > 1 else None
+
+
+def _apply(users, expires, user_id, expires_at):
+    if expires_at is _REMOVED:
+        users.discard(user_id)
+        expires.pop(user_id, None)
+        return
+    users.add(user_id)
+    if expires_at is None:
+        expires.pop(user_id, None)
+    else:
+        expires[user_id] = expires_at
+
+
+def _merge(view):
+    """Сливает изменения представления (множество, сроки, изменения) в новые множество и сроки."""
+    users, expires, changes = view
+    if not changes:
+        return users, expires
+    users, expires = set(users), dict(expires)
+    for user_id, expires_at in changes.items():
+        _apply(users, expires, user_id, expires_at)
+    return frozenset(users), expires
+
+
+def _lookup(view, user_id):
+    """Срок доступа по представлению: None — бессрочно, _REMOVED — пользователя нет в списке."""
+    users, expires, changes = view
+    expires_at = changes.get(user_id, _MISSING)
+    if expires_at is not _MISSING:
+        return expires_at
+    if user_id not in users:
+        return _REMOVED
+    return expires.get(user_id)
+
+
+def _record(op, user_id, expires_at=None):
+    if expires_at is None:
+        return f"{op}{user_id}\n"
+    return f"{op}{user_id} {int(expires_at)}\n"
+
+
+def expires_path(snapshot_path):
+    """Файл сроков доступа рядом со снимком: paid_users.json -> paid_users.expires.json."""
+    root, ext = os.path.splitext(snapshot_path)
+    return f"{root}.expires{ext or '.json'}"
+
+
+def _user_ids(values, path):
+    """Проверяет, что в списке только id; иначе ValueError."""
+    users = set(values)
+    invalid = [value for value in users if type(value) is not int]
+    if invalid:
+        raise ValueError(f"{path}: в списке оплативших не id: {invalid[:5]!r}")
+    return users
+
+
+def read_paid_users(snapshot_path=PAID_USERS_FILE, journal_path=PAID_USERS_JOURNAL):
+    """
+    Читает снимок и сроки доступа и применяет к ним журнал.
+
+    Снимок — просто список id (его правят и внешние скрипты), сроки лежат
+    отдельно в expires_path(). Снимок не из одних id — ValueError.
+
+    Возвращает (множество id, словарь id -> срок доступа, число записей журнала,
+    сколько байт журнала прочитано).
+    """
+    expires = {}
+    try:
+        with open(snapshot_path, "r") as file:
+            # Повреждённый снимок не глотаем: пустой список заблокирует всех клиентов
+            snapshot = json.load(file)
+    except FileNotFoundError:
+        snapshot = []
+    if isinstance(snapshot, dict):
+        # Снимок со сроками внутри, как его одно время писал compact()
+        users = _user_ids(snapshot["users"], snapshot_path)
+        expires = {int(user_id): ts for user_id, ts in snapshot.get("expires", {}).items()}
+    elif isinstance(snapshot, list):
+        users = _user_ids(snapshot, snapshot_path)
+        try:
+            with open(expires_path(snapshot_path), "r") as file:
+                expires = {int(user_id): ts for user_id, ts in json.load(file).items()}
+        except FileNotFoundError:
+            pass
+    else:
+        raise ValueError(f"{snapshot_path}: ожидается список id")
+    # Сроки тех, кого внешний скрипт убрал из списка, не нужны
+    expires = {user_id: ts for user_id, ts in expires.items() if user_id in users}
+
+    records, offset = 0, 0
+    try:
+        with open(journal_path, "rb") as journal:
+            for raw in journal:
+                if not raw.endswith(b"\n"):
+                    # Недописанная строка после падения — изменение не подтверждено
+                    logger.warning("Пропущена недописанная запись журнала: %r", raw)
+                    break
+                _apply(users, expires, *_parse(raw.decode("utf-8")))
+                records += 1
+                offset += len(raw)
+    except FileNotFoundError:
+        pass
+    return users, expires, records, offset
+
+
+def _file_id(path):
+    """Отпечаток файла: меняется, когда снимок атомарно подменяют через os.replace."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _truncate_partial_tail(path):
+    """Отрезает недописанную последнюю строку журнала, чтобы новые записи не склеились с ней."""
     try:
-        with open(PAID_USERS_FILE, "r") as file:
-            return set(json.load(file))  # Преобразуем в set для быстрого поиска
-    except (FileNotFoundError, json.JSONDecodeError):
-        return set()
+        with open(path, "rb+") as journal:
+            data = journal.read()
+            if data and not data.endswith(b"\n"):
+                journal.truncate(data.rfind(b"\n") + 1)
+    except FileNotFoundError:
+        pass
+
+
+class PaidUsersStore:
+    """
+    Список оплативших: снимок в JSON + журнал изменений.
+
+    Каждое изменение дописывается в журнал одной строкой ("+id [срок]" или "-id")
+    и сбрасывается на диск, поэтому стоит O(1) операций ввода-вывода.
+    Пакет изменений пишется одним fsync. Когда журнал разрастается, снимок
+    атомарно пересобирается (временный файл + os.replace), а журнал обнуляется.
+
+    В памяти список — неизменяемое представление (frozenset, сроки, свежие
+    изменения), которое подменяется одним присваиванием. Проверка is_paid
+    читает его без блокировок, в том числе из других потоков (выгрузка).
+    Свежие изменения лежат отдельным маленьким словарём и сливаются
+    в новое множество, когда их набирается MERGE_THRESHOLD, поэтому
+    изменение не копирует весь список.
+
+    Снимок остаётся простым списком id, чтобы его могли править внешние
+    скрипты (например, платёжный); сроки доступа compact() пишет отдельным
+    файлом (expires_path). Сроки дополнительно лежат в куче (срок, id),
+    поэтому истёкших можно снимать с её вершины, не перебирая весь список.
+
+    Писать в файлы должен один процесс. Остальные открывают хранилище
+    с read_only=True и подхватывают его изменения через refresh() или watch().
+    """
+
+    def __init__(self, snapshot_path=PAID_USERS_FILE, journal_path=PAID_USERS_JOURNAL,
+                 compact_threshold=COMPACT_THRESHOLD, read_only=False):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_threshold = compact_threshold
+        self.read_only = read_only
+        self._view = (frozenset(), {}, {})
+        self._sorted = (None, [])  # множество представления и его id по возрастанию
+        self._listeners = []
+        self._invalidated = asyncio.Event()
+        self._journal = None
+        self._reload()
+        if not read_only:
+            _truncate_partial_tail(journal_path)
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    @property
+    def users(self):
+        """Текущий список как frozenset."""
+        return _merge(self._view)[0]
+
+    def _publish(self, changes):
+        users, expires, pending = self._view
+        pending = {**pending, **changes}
+        if len(pending) > MERGE_THRESHOLD:
+            users, expires = _merge((users, expires, pending))
+            pending = {}
+        self._view = (users, expires, pending)
+
+    def _reload(self):
+        # Отпечаток берём до чтения: если снимок подменят во время чтения, следующий refresh это заметит
+        snapshot_id = _file_id(self.snapshot_path)
+        users, expires, self._journal_records, self._journal_offset = read_paid_users(
+            self.snapshot_path, self.journal_path
+        )
+        self._snapshot_id = snapshot_id
+        self._view = (frozenset(users), expires, {})
+        self._expiry_heap = [(ts, user_id) for user_id, ts in expires.items()]
+        heapq.heapify(self._expiry_heap)
+
+    def refresh(self):
+        """
+        Подхватывает изменения, сделанные другим процессом.
+
+        Новый снимок — полная перезагрузка, иначе дочитываются только
+        новые строки журнала. Возвращает True, если что-то изменилось.
+        """
+        started = time.perf_counter()
+        snapshot_id = _file_id(self.snapshot_path)
+        if snapshot_id != self._snapshot_id:
+            self._reload()
+            self._observe_reload("snapshot", started, snapshot_id[1] if snapshot_id else None)
+            return True
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size <= self._journal_offset:
+            return False
+
+        changes = {}
+        with open(self.journal_path, "rb") as journal:
+            journal.seek(self._journal_offset)
+            for raw in journal:
+                if not raw.endswith(b"\n"):
+                    break  # писатель ещё не дописал строку
+                user_id, expires_at = _parse(raw.decode("utf-8"))
+                changes[user_id] = expires_at
+                if expires_at is not None and expires_at is not _REMOVED:
+                    heapq.heappush(self._expiry_heap, (expires_at, user_id))
+                self._journal_records += 1
+                self._journal_offset += len(raw)
+        self._publish(changes)
+        self._observe_reload("journal", started, stat.st_mtime_ns)
+        return True
+
+    def _observe_reload(self, source, started, mtime_ns):
+        registry.observe("paid_users_reload_seconds", time.perf_counter() - started, source=source)
+        if mtime_ns is not None:
+            # Сколько прошло от изменения файла до того, как процесс его увидел
+            registry.observe("paid_users_reload_lag_seconds", max(0.0, time.time() - mtime_ns / 1e9))
+
+    async def watch(self, interval=WATCH_INTERVAL):
+        """
+        Следит за файлами списка (по отпечатку снимка и размеру журнала).
+
+        Подхватывает правки из других процессов и внешних скриптов
+        (например, перезаписанный paid_users.json) без перезапуска бота.
+        После invalidate() проверяет сразу, не дожидаясь интервала.
+        """
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._invalidated.wait(), interval)
+            self._invalidated.clear()
+            try:
+                self.refresh()
+            except (OSError, ValueError) as e:
+                # Снимок могли поймать на середине ручной правки — старый список остаётся в силе
+                logger.error("Не удалось перечитать список оплативших: %s", e)
+
+    def invalidate(self):
+        """Сообщает watch(), что список изменился (например, по сигналу от процесса-писателя)."""
+        self._invalidated.set()
+
+    def subscribe(self, callback):
+        """callback() вызывается после каждой записи в журнал — чтобы оповестить другие процессы."""
+        self._listeners.append(callback)
+
+    def _write(self, changes, lines):
+        if self.read_only:
+            raise RuntimeError("Список оплативших открыт только для чтения")
+        # Сначала в память: если журнал переполнится, compact() запишет снимок уже с этими изменениями
+        self._publish(changes)
+        data = "".join(lines)
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_records += len(lines)
+        self._journal_offset += len(data.encode("utf-8"))
+        if self._journal_records >= self.compact_threshold:
+            self.compact()
+        for callback in self._listeners:
+            callback()
+
+    def add(self, user_id, expires_at=None):
+        self.add_many([(user_id, expires_at)])
+
+    def remove(self, user_id):
+        self.remove_many([user_id])
+
+    def add_many(self, entries):
+        """Добавляет пакет пар (id, срок) одной записью в журнал. Срок — unix-время или None."""
+        changes, lines = {}, []
+        for user_id, expires_at in entries:
+            if expires_at is not None:
+                expires_at = int(expires_at)
+                heapq.heappush(self._expiry_heap, (expires_at, user_id))
+            changes[user_id] = expires_at
+            lines.append(_record("+", user_id, expires_at))
+        if lines:
+            self._write(changes, lines)
+
+    def remove_many(self, user_ids):
+        """Удаляет пакет пользователей одной записью в журнал."""
+        changes, lines = {}, []
+        for user_id in user_ids:
+            changes[user_id] = _REMOVED
+            lines.append(_record("-", user_id))
+        if lines:
+            self._write(changes, lines)
+
+    def replace(self, user_ids):
+        """Заменяет весь список (сроки оставшихся сохраняются) и записывает новый снимок."""
+        users = frozenset(user_ids)
+        expires = _merge(self._view)[1]
+        self._view = (users, {user_id: ts for user_id, ts in expires.items() if user_id in users}, {})
+        self.compact()
+
+    def is_paid(self, user_id, now=None):
+        expires_at = _lookup(self._view, user_id)
+        if expires_at is _REMOVED:
+            return False
+        return expires_at is None or expires_at > (time.time() if now is None else now)
+
+    def sweep_expired(self, now=None):
+        """Удаляет пользователей с истёкшим сроком. Возвращает список удалённых id."""
+        now = time.time() if now is None else now
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._expiry_heap)
+            # В куче могут остаться устаревшие записи после продления или удаления
+            if _lookup(self._view, user_id) == expires_at:
+                expired.append(user_id)
+        self.remove_many(expired)
+        return expired
+
+    def _sorted_users(self, users):
+        """id множества по возрастанию; сортируется один раз, пока множество не пересобрано."""
+        cached, ordered = self._sorted
+        if cached is not users:
+            ordered = sorted(users)
+            self._sorted = (users, ordered)
+        return ordered
+
+    def items(self):
+        """
+        Пары (id, срок или None), отсортированные по id, на момент вызова.
+
+        Множество не копируется: его отсортированные id берутся из кэша,
+        а свежие изменения (их не больше MERGE_THRESHOLD) вливаются по ходу.
+        """
+        users, expires, changes = self._view
+        unchanged = (user_id for user_id in self._sorted_users(users) if user_id not in changes)
+        added = sorted(user_id for user_id, expires_at in changes.items() if expires_at is not _REMOVED)
+        for user_id in heapq.merge(unchanged, added):
+            yield user_id, changes[user_id] if user_id in changes else expires.get(user_id)
+
+    def compact(self):
+        """Атомарно записывает снимок текущего списка и обнуляет журнал."""
+        users, expires = _merge(self._view)
+        self._view = (users, expires, {})
+        # Сначала сроки, потом список: по подмене списка другие процессы перечитывают оба
+        for path, data in ((expires_path(self.snapshot_path), expires), (self.snapshot_path, list(users))):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+        _fsync_dir(self.snapshot_path)
+        self._snapshot_id = _file_id(self.snapshot_path)
+
+        # Если упадём до обнуления журнала, повторное применение записей
+        # поверх нового снимка даст тот же результат
+        self._journal.close()
+        self._journal = open(self.journal_path, "w", encoding="utf-8")
+        self._journal_records = 0
+        self._journal_offset = 0
+        # Заодно выбрасываем из кучи устаревшие записи
+        self._expiry_heap = [(ts, user_id) for user_id, ts in expires.items()]
+        heapq.heapify(self._expiry_heap)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+
+
+# Загружаем пользователей в память.
+# В многопроцессном режиме пишет только один воркер, остальные читают
+store = PaidUsersStore(read_only=os.getenv("PAID_USERS_READ_ONLY") == "1")
+registry.describe("paid_users_reload_seconds", "Время перечитывания списка оплативших")
+registry.describe("paid_users_reload_lag_seconds", "Задержка от изменения файла списка до его применения")
+
+
+def __getattr__(name):
+    # paid_users раньше был изменяемым множеством модуля; теперь это текущий снимок
+    if name == "paid_users":
+        return store.users
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def load_paid_users():
+    """Загружает список оплативших пользователей (снимок + журнал)."""
+    return read_paid_users(PAID_USERS_FILE, PAID_USERS_JOURNAL)[0]
+
 
 def save_paid_users(paid_users):
-    """Сохраняет список оплативших пользователей в JSON-файл."""
-    with open(PAID_USERS_FILE, "w") as file:
-        json.dump(list(paid_users), file)
+    """Сохраняет список оплативших пользователей в снимок и обнуляет журнал."""
+    store.replace(paid_users)
 
-# Загружаем пользователей в память
-paid_users = load_paid_users()
 
 def is_user_paid(user_id):
     """Проверяет, есть ли пользователь в списке оплативших"""
-    return user_id in paid_users
+    return store.is_paid(user_id)
+
+
+def add_user(user_id, expires_at=None):
+    """Добавляет пользователя в список оплативших и дописывает изменение в журнал"""
+    store.add(user_id, expires_at)
 
-def add_user(user_id):
-    """Добавляет пользователя в список оплативших и сохраняет в файл"""
-    paid_users.add(user_id)
-    save_paid_users(paid_users)
 
 def remove_user(user_id):
-    """Удаляет пользователя из списка оплативших и обновляет файл"""
-    paid_users.discard(user_id)
-    save_paid_users(paid_users)
\ No newline at end of file
+    """Удаляет пользователя из списка оплативших и дописывает изменение в журнал"""
+    store.remove(user_id)
+
+
+def add_users(user_ids, expires_at=None):
+    """Добавляет сразу несколько пользователей одной записью в журнал"""
+    store.add_many((user_id, expires_at) for user_id in user_ids)
+
+
+def add_users_with_expiry(entries):
+    """Добавляет пары (id, срок доступа или None) одной записью в журнал"""
+    store.add_many(entries)
+
+
+def remove_users(user_ids):
+    """Удаляет сразу несколько пользователей одной записью в журнал"""
+    store.remove_many(user_ids)
+
+
+def sweep_expired_users():
+    """Снимает доступ у пользователей с истёкшим сроком"""
+    return store.sweep_expired()
+
+
+def refresh_paid_users():
+    """Подхватывает изменения списка, сделанные другим процессом"""
+    return store.refresh()
+
+
+async def watch_paid_users(interval=WATCH_INTERVAL):
+    """Фоновая задача: подхватывает изменения файлов списка без перезапуска"""
+    await store.watch(interval)
+
+
+def invalidate_paid_users():
+    """Просит перечитать список, не дожидаясь очередной проверки"""
+    store.invalidate()
+
+
+def iter_paid_users():
+    """Перебирает пары (id, срок доступа или None) для выгрузки"""
+    return store.items()
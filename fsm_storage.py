@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    DEFAULT_DESTINY, BaseStorage, DefaultKeyBuilder, StateType, StorageKey,
+)
+
+logger = logging.getLogger(__name__)
+
+FSM_DB_PATH = "fsm.sqlite3"
+FLUSH_INTERVAL = 0.05  # секунды между пакетными записями на диск
+
+
+def read_idle_sessions(path: str, since: float) -> list:
+    """
+    (chat_id, состояние, время изменения) личных чатов из базы FSM, которые
+    менялись после since и которым после этого ещё не было напоминания.
+    Открывает своё соединение, поэтому годится для вызова из другого потока.
+    """
+    db = sqlite3.connect(path)
+    try:
+        rows = db.execute(
+            "SELECT key, state, updated_at FROM fsm"
+            " WHERE state IS NOT NULL AND updated_at >= ?"
+            " AND (reminded_at IS NULL OR reminded_at < updated_at)",
+            (since,),
+        ).fetchall()
+    finally:
+        db.close()
+    sessions = []
+    for db_key, state, updated_at in rows:
+        # fsm:<бот>:<чат>:<пользователь>:<destiny>; группы и чаты с темами пропускаем
+        parts = db_key.split(":")
+        if len(parts) == 5 and parts[2] == parts[3]:
+            sessions.append((int(parts[2]), state, updated_at))
+    return sessions
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite (режим WAL) с отложенной пакетной записью.
+
+    Состояние и данные каждого ключа держатся в памяти, изменения копятся
+    и раз в ``flush_interval`` секунд пишутся на диск одной транзакцией.
+    При падении теряются только изменения последнего окна записи.
+    Записи ушедших игроков выгружаются из памяти через ``evict()``
+    (см. sessions.SessionTracker) и при следующем обращении читаются из базы.
+    """
+
+    def __init__(self, path: str = FSM_DB_PATH, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: Dict[str, list] = {}
+        self._dirty: Dict[str, list] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+        self._db = self._connect()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY,"
+            " state TEXT,"
+            " data TEXT NOT NULL DEFAULT '{}',"
+            " updated_at REAL,"
+            " reminded_at REAL)"
+        )
+        # Базы, созданные до появления времени изменения и напоминаний
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(fsm)")}
+        for column in ("updated_at", "reminded_at"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE fsm ADD COLUMN {column} REAL")
+        self._db.commit()
+        # Отдельное соединение для записи из фонового потока:
+        # в WAL чтение и запись не блокируют друг друга
+        self._writer = self._connect(check_same_thread=False)
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=check_same_thread)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _load(self, key: StorageKey) -> list:
+        """Возвращает запись [state, data] из кэша, при промахе читает её из базы."""
+        db_key = self.key_builder.build(key)
+        record = self._cache.get(db_key)
+        if record is None:
+            row = self._db.execute("SELECT state, data FROM fsm WHERE key = ?", (db_key,)).fetchone()
+            record = [row[0], json.loads(row[1])] if row else [None, {}]
+            self._cache[db_key] = record
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: list) -> None:
+        self._dirty[self.key_builder.build(key)] = record
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        # Изменения, пришедшие во время записи, уходят следующим пакетом:
+        # пока эта задача не завершилась, _mark_dirty новую не создаёт
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Записывает все накопленные изменения одной транзакцией."""
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            rows = [
+                (db_key, state, json.dumps(data, ensure_ascii=False), now)
+                for db_key, (state, data) in self._dirty.items()
+            ]
+            self._dirty = {}
+            try:
+                await asyncio.to_thread(self._write_rows, rows)
+            except sqlite3.Error:
+                logger.exception("Не удалось сохранить FSM-состояния (%d записей)", len(rows))
+
+    def _write_rows(self, rows: list) -> None:
+        with self._writer:
+            self._writer.executemany(
+                "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,"
+                " updated_at = excluded.updated_at",
+                rows,
+            )
+
+    def evict(self, key: StorageKey) -> bool:
+        """Выгружает запись из памяти (в базе она остаётся). False — она ещё не записана на диск."""
+        db_key = self.key_builder.build(key)
+        if db_key in self._dirty or self._write_lock.locked():
+            return False
+        self._cache.pop(db_key, None)
+        return True
+
+    @property
+    def cached(self) -> int:
+        """Сколько записей сейчас в памяти."""
+        return len(self._cache)
+
+    def _write_reminded(self, db_key: str, reminded_at: float) -> None:
+        with self._writer:
+            self._writer.execute("UPDATE fsm SET reminded_at = ? WHERE key = ?", (reminded_at, db_key))
+
+    async def mark_reminded(self, key: StorageKey) -> None:
+        """Запоминает, что игроку отправлено напоминание (чтобы не повторять его после перезапуска)."""
+        async with self._write_lock:
+            try:
+                await asyncio.to_thread(self._write_reminded, self.key_builder.build(key), time.time())
+            except sqlite3.Error:
+                logger.exception("Не удалось отметить напоминание для %s", key.chat_id)
+
+    def idle_sessions(self, since: float) -> list:
+        """См. read_idle_sessions; вызывается через asyncio.to_thread."""
+        return read_idle_sessions(self.path, since)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._load(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._load(key)
+        record[1] = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._load(key)[1].copy()
+
+    async def get_state_and_data(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        record = self._load(key)
+        return record[0], record[1].copy()
+
+    async def set_state_and_data(self, key: StorageKey, state: StateType, data: Dict[str, Any]) -> None:
+        record = self._load(key)
+        record[0] = state.state if isinstance(state, State) else state
+        record[1] = data.copy()
+        self._mark_dirty(key, record)
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._writer.close()
+        self._db.close()
+
+
+class TransactionalFSMContext(FSMContext):
+    """
+    FSMContext одного обновления: состояние и данные читаются из хранилища
+    один раз, изменения копятся в памяти и записываются одним commit().
+    """
+
+    def __init__(self, storage: BaseStorage, key: StorageKey) -> None:
+        super().__init__(storage, key)
+        self._state: Optional[str] = None
+        self._data: Optional[Dict[str, Any]] = None  # None — данные ещё не читали
+        self._state_changed = False
+        self._data_changed = False
+
+    async def load(self) -> None:
+        # Хранилище, которое умеет отдать запись целиком, читается за одно обращение
+        load = getattr(self.storage, "get_state_and_data", None)
+        if load is not None:
+            self._state, self._data = await load(self.key)
+        else:
+            self._state = await self.storage.get_state(self.key)
+
+    async def _loaded_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(self.key)
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_changed = True
+
+    async def get_state(self) -> Optional[str]:
+        return self._state
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        self._data = data.copy()
+        self._data_changed = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        return (await self._loaded_data()).copy()
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return (await self._loaded_data()).get(key, default)
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        self._data = {**await self._loaded_data(), **kwargs}
+        self._data_changed = True
+        return self._data.copy()
+
+    async def clear(self) -> None:
+        self._state, self._data = None, {}
+        self._state_changed = self._data_changed = True
+
+    async def commit(self) -> None:
+        """Записывает изменения обновления: одним обращением, если хранилище это умеет."""
+        save = getattr(self.storage, "set_state_and_data", None)
+        if save is not None and (self._state_changed or self._data_changed):
+            await save(self.key, self._state, await self._loaded_data())
+        else:
+            if self._state_changed:
+                await self.storage.set_state(self.key, self._state)
+            if self._data_changed:
+                await self.storage.set_data(self.key, self._data)
+        self._state_changed = self._data_changed = False
+
+
+class TransactionalFSMMiddleware(FSMContextMiddleware):
+    """
+    FSM-middleware с единицей работы на обновление.
+
+    Вместо обращений к хранилищу на каждый get_data/update_data/set_state
+    обработчик работает с копией в памяти, а изменения записываются после
+    него одним commit(). Если обработчик упал, изменения отбрасываются.
+    Подключается вместо встроенной: Dispatcher(disable_fsm=True) и
+    dp.update.outer_middleware(TransactionalFSMMiddleware(...)).
+    """
+
+    async def __call__(self, handler, event, data):
+        context = self.resolve_event_context(data["bot"], data)
+        data["fsm_storage"] = self.storage
+        if context is None:
+            return await handler(event, data)
+        async with self.events_isolation.lock(key=context.key):
+            await context.load()
+            data.update({"state": context, "raw_state": await context.get_state()})
+            result = await handler(event, data)
+            await context.commit()
+            return result
+
+    def get_context(self, bot, chat_id, user_id, thread_id=None, business_connection_id=None,
+                    destiny=DEFAULT_DESTINY) -> TransactionalFSMContext:
+        return TransactionalFSMContext(
+            storage=self.storage,
+            key=StorageKey(
+                user_id=user_id,
+                chat_id=chat_id,
+                bot_id=bot.id,
+                thread_id=thread_id,
+                business_connection_id=business_connection_id,
+                destiny=destiny,
+            ),
+        )
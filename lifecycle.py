@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from metrics import registry
+
+UPDATE_OFFSET_FILE = "update_offset.json"
+CHECKPOINT_INTERVAL = 1  # секунды между сохранениями отметки
+# После недели без обновлений Telegram может начать update_id заново со случайного числа
+CHECKPOINT_MAX_AGE = 6 * 86400
+DRAIN_TIMEOUT = 20  # Heroku ждёт после SIGTERM 30 секунд, дальше SIGKILL
+
+logger = logging.getLogger(__name__)
+registry.describe("updates_skipped_total", "Обновления, обработанные ещё до перезапуска и пропущенные")
+
+
+def read_checkpoint(path, max_age=CHECKPOINT_MAX_AGE):
+    """update_id из файла отметки или None, если отметки нет или она устарела."""
+    try:
+        with open(path, "r") as file:
+            checkpoint = json.load(file)
+        update_id, saved_at = int(checkpoint["update_id"]), float(checkpoint["saved_at"])
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Отметка %s повреждена и пропущена: %s", path, e)
+        return None
+    if time.time() - saved_at > max_age:
+        logger.info("Отметка %s старше %d с, начинаем без неё", path, max_age)
+        return None
+    return update_id
+
+
+def process_uptime():
+    """Секунды с запуска процесса (по /proc в Linux) или 0, если узнать нельзя."""
+    try:
+        with open("/proc/self/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class UpdateCheckpoint(BaseMiddleware):
+    """
+    Отметка последнего обработанного обновления и дообработка при остановке.
+
+    Обновления обрабатываются параллельно и заканчиваются не по порядку,
+    поэтому отметка — наибольший update_id, до которого обработано всё:
+    номер самого раннего обновления в работе минус один. Раз в interval
+    секунд она сохраняется в файл, а при остановке — после drain().
+    После перезапуска обновления с номером не больше сохранённого
+    (Telegram повторит те, что не успели подтвердить) пропускаются,
+    а фронт многопроцессного режима начинает с offset.
+
+    Регистрируется первой внешней middleware обновлений: части альбома
+    считаются обработанными, когда их забрал MediaGroupCollector, поэтому
+    при остановке его закрывают после drain().
+
+    Заодно меряет время от запуска процесса до готовности и до первого
+    обработанного обновления.
+    """
+
+    def __init__(self, path=UPDATE_OFFSET_FILE, registry=registry):
+        self.path = path
+        self.resume_from = read_checkpoint(path) if path else None
+        self.update_id = self.resume_from
+        self.startup_seconds = None
+        self.first_update_seconds = None
+        self._created = time.monotonic() - process_uptime()
+        self._saved = self.update_id
+        self._seen = None
+        self._in_flight = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._registry = registry
+        registry.gauge("updates_in_flight", lambda: len(self._in_flight))
+        registry.gauge("startup_seconds", lambda: self.startup_seconds or 0)
+        registry.gauge("first_update_seconds", lambda: self.first_update_seconds or 0)
+        if self.resume_from is not None:
+            logger.info("Продолжаем после обновления %s", self.resume_from)
+
+    @property
+    def offset(self):
+        """offset для getUpdates: следующее необработанное обновление (или None)."""
+        return None if self.update_id is None else self.update_id + 1
+
+    def ready(self):
+        """Отмечает, что кэши прогреты и бот готов принимать обновления."""
+        self.startup_seconds = time.monotonic() - self._created
+        logger.info("Готов к приёму обновлений через %.2f с после запуска", self.startup_seconds)
+
+    def begin(self, update_id):
+        """Берёт обновление в работу; False — оно уже обработано до перезапуска."""
+        if self.resume_from is not None and update_id <= self.resume_from:
+            self._registry.inc("updates_skipped_total")
+            logger.info("Обновление %s уже обработано до перезапуска, пропускаем", update_id)
+            return False
+        self._in_flight.add(update_id)
+        self._idle.clear()
+        if self._seen is None or update_id > self._seen:
+            self._seen = update_id
+        return True
+
+    def end(self, update_id):
+        self._in_flight.discard(update_id)
+        done = min(self._in_flight) - 1 if self._in_flight else self._seen
+        if self.update_id is None or done > self.update_id:
+            self.update_id = done
+        if self.first_update_seconds is None:
+            self.first_update_seconds = time.monotonic() - self._created
+            logger.info("Первое обновление обработано через %.2f с после запуска", self.first_update_seconds)
+        if not self._in_flight:
+            self._idle.set()
+
+    async def __call__(self, handler, event: Update, data):
+        if not self.begin(event.update_id):
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            self.end(event.update_id)
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        """Ждёт, пока закончатся обновления в работе."""
+        # Задачи обновлений, созданные только что, ещё не дошли до middleware
+        await asyncio.sleep(0)
+        if self._in_flight:
+            logger.info("Дообрабатываем обновлений: %d", len(self._in_flight))
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.error("Не дообработано обновлений при остановке: %d", len(self._in_flight))
+
+    def _write(self, update_id):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"update_id": update_id, "saved_at": time.time()}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        """Сохраняет отметку, если она сдвинулась с прошлого сохранения."""
+        update_id = self.update_id
+        if not self.path or update_id is None or update_id == self._saved:
+            return
+        try:
+            await asyncio.to_thread(self._write, update_id)
+        except OSError as e:
+            logger.error("Не удалось сохранить отметку обновлений %s: %s", self.path, e)
+            return
+        self._saved = update_id
+
+    async def run(self, interval=CHECKPOINT_INTERVAL):
+        """Периодически сохраняет отметку, чтобы после падения не обрабатывать всё заново."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.save()
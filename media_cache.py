@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+MEDIA_CACHE_FILE = "media_cache.json"
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """
+    Кэш file_id для статичных картинок бота.
+
+    Файл загружается в Telegram один раз, полученный file_id сохраняется
+    на диск под sha256 содержимого: если картинку заменить, хэш изменится
+    и она будет загружена заново. Если Telegram отверг сохранённый file_id,
+    картинка тоже загружается заново.
+    """
+
+    def __init__(self, path=MEDIA_CACHE_FILE):
+        self.path = path
+        self._hashes = {}  # путь -> (mtime_ns, размер, sha256)
+        self._locks = {}
+        try:
+            with open(self.path, "r") as file:
+                self.file_ids = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Потеря кэша не страшна: картинки просто загрузятся ещё раз
+            self.file_ids = {}
+
+    def content_hash(self, path):
+        """sha256 файла; пересчитывается, только если файл изменился."""
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                digest.update(chunk)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+        return digest.hexdigest()
+
+    def warm(self, paths):
+        """Заранее считает хэши картинок, чтобы первый /start не читал файлы с диска."""
+        for path in paths:
+            try:
+                digest = self.content_hash(path)
+            except OSError as e:
+                logger.warning("Картинка %s недоступна: %s", path, e)
+                continue
+            if digest not in self.file_ids:
+                logger.info("Для %s ещё нет file_id, картинка загрузится при первой отправке", path)
+
+    def _save(self):
+        # Воркеры шардов сохраняют один файл: у каждого процесса свой временный
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(self.file_ids, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # Потеря кэша не страшна, а картинка уже отправлена
+            logger.warning("Не удалось сохранить кэш file_id %s: %s", self.path, e)
+
+    async def send_photo(self, message: types.Message, path, **kwargs):
+        """Отправляет картинку по file_id из кэша, а при его отсутствии загружает файл."""
+        digest = self.content_hash(path)
+        file_id = self.file_ids.get(digest)
+        if file_id is not None:
+            try:
+                return await message.answer_photo(file_id, **kwargs)
+            except TelegramBadRequest as e:
+                logger.warning("Telegram отклонил file_id для %s: %s", path, e)
+                if self.file_ids.get(digest) == file_id:
+                    del self.file_ids[digest]
+
+        # Пока идёт первая загрузка, остальные ждут её file_id, а не грузят файл повторно
+        async with self._locks.setdefault(digest, asyncio.Lock()):
+            file_id = self.file_ids.get(digest)
+            if file_id is None:
+                sent = await message.answer_photo(FSInputFile(path), **kwargs)
+                self.file_ids[digest] = sent.photo[-1].file_id
+                self._save()
+                return sent
+        # Дождавшиеся загрузки отправляют уже вне блокировки, все разом
+        return await message.answer_photo(file_id, **kwargs)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+ALBUM_WINDOW = 0.3  # секунды тишины после последней части, и альбом считается полученным
+MAX_ALBUM_SIZE = 10  # больше частей в одном альбоме Telegram не присылает
+
+logger = logging.getLogger(__name__)
+
+
+class _Album:
+    __slots__ = ("handler", "event", "data", "messages", "timer")
+
+    def __init__(self, handler, event, data):
+        self.handler = handler
+        self.event = event
+        self.data = data
+        self.messages = []
+        self.timer = None
+
+
+class MediaGroupCollector(BaseMiddleware):
+    """
+    Собирает части альбома (сообщения с одним media_group_id) в одно обновление.
+
+    Telegram присылает каждую фотографию альбома отдельным обновлением.
+    Коллектор копит их, пока части приходят чаще, чем раз в window секунд,
+    и потом один раз передаёт дальше первое обновление, а все сообщения
+    альбома — в data["album"] (по порядку message_id).
+
+    Обновления альбома сразу возвращаются как обработанные, а сам альбом
+    обрабатывается отдельной задачей: иначе источник, который подаёт
+    обновления по одному (воркер шарда), ждал бы частей, которые ещё не подал.
+    Регистрируется внешней middleware обновлений раньше FSM, чтобы весь
+    альбом был одной транзакцией состояния.
+    """
+
+    def __init__(self, window=ALBUM_WINDOW):
+        self.window = window
+        self._albums = {}
+        self._tasks = set()
+
+    async def __call__(self, handler, event: Update, data):
+        message = event.message
+        if message is None or message.media_group_id is None:
+            return await handler(event, data)
+
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = _Album(handler, event, data)
+        album.messages.append(message)
+        if album.timer is not None:
+            album.timer.cancel()
+        if len(album.messages) >= MAX_ALBUM_SIZE:
+            self._flush(key)
+        else:
+            album.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return
+        if album.timer is not None:
+            album.timer.cancel()
+        album.data["album"] = sorted(album.messages, key=lambda message: message.message_id)
+        task = asyncio.create_task(self._handle(album))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, album):
+        try:
+            await album.handler(album.event, album.data)
+        except Exception:
+            logger.exception(
+                "Ошибка обработки альбома %s из %d сообщений",
+                album.messages[0].media_group_id, len(album.messages),
+            )
+
+    async def close(self):
+        """Обрабатывает недособранные альбомы и ждёт, пока закончатся начатые."""
+        for key in list(self._albums):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,282 @@
+import bisect
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.fsm.storage.base import BaseStorage
+from aiohttp import web
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: запись — один bisect и два сложения."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+    """
+    Метрики процесса: гистограммы, счётчики и вычисляемые показатели.
+
+    Метрика определяется именем и набором меток; значения хранятся
+    в словарях по кортежу меток, без блокировок — всё в одном event loop.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def histogram(self, name, buckets=BUCKETS, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func):
+        """Показатель, который вычисляется в момент чтения (например, длина очереди)."""
+        self.gauges[name] = func
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus."""
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for name, func in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+registry.describe("bot_handler_seconds", "Время обработчика по имени и состоянию FSM")
+registry.describe("bot_api_seconds", "Время запроса к Bot API по методу")
+registry.describe("bot_api_retry_after_total", "Ответы RetryAfter от Bot API")
+registry.describe("bot_api_errors_total", "Ошибки запросов к Bot API")
+registry.describe("bot_handler_errors_total", "Исключения в обработчиках")
+registry.describe("fsm_storage_seconds", "Время операций FSM-хранилища")
+registry.describe("outbound_queue_depth", "Заданий в очереди отправки в служебные чаты")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Время каждого обработчика с метками handler и state.
+
+    Регистрируется внутренней middleware (dp.message.middleware(...)),
+    поэтому к моменту вызова уже известен выбранный обработчик.
+    """
+
+    def __init__(self, registry=registry):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        callback = data["handler"].callback
+        name = getattr(callback, "__qualname__", None) or type(callback).__name__
+        labels = {"handler": name, "state": data.get("raw_state") or ""}
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.registry.inc("bot_handler_errors_total", **labels)
+            raise
+        finally:
+            self.registry.observe("bot_handler_seconds", time.perf_counter() - start, **labels)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API по методу, RetryAfter и ошибки (bot.session.middleware(...))."""
+
+    def __init__(self, registry=registry):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            self.registry.inc("bot_api_retry_after_total", method=name)
+            raise
+        except Exception as e:
+            self.registry.inc("bot_api_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            self.registry.observe("bot_api_seconds", time.perf_counter() - start, method=name)
+
+
+class TimedStorage(BaseStorage):
+    """Обёртка FSM-хранилища, которая меряет get/set state и data."""
+
+    def __init__(self, storage: BaseStorage, registry=registry):
+        self.storage = storage
+        self.registry = registry
+        self._histograms = {
+            op: registry.histogram("fsm_storage_seconds", op=op)
+            for op in ("get_state", "set_state", "get_data", "set_data",
+                       "get_state_and_data", "set_state_and_data")
+        }
+        # Запись целиком — только если её умеет само хранилище (см. TransactionalFSMContext)
+        if hasattr(storage, "get_state_and_data"):
+            self.get_state_and_data = self._get_state_and_data
+        if hasattr(storage, "set_state_and_data"):
+            self.set_state_and_data = self._set_state_and_data
+
+    async def set_state(self, key, state=None):
+        start = time.perf_counter()
+        await self.storage.set_state(key, state)
+        self._histograms["set_state"].observe(time.perf_counter() - start)
+
+    async def get_state(self, key):
+        start = time.perf_counter()
+        state = await self.storage.get_state(key)
+        self._histograms["get_state"].observe(time.perf_counter() - start)
+        return state
+
+    async def set_data(self, key, data):
+        start = time.perf_counter()
+        await self.storage.set_data(key, data)
+        self._histograms["set_data"].observe(time.perf_counter() - start)
+
+    async def get_data(self, key):
+        start = time.perf_counter()
+        data = await self.storage.get_data(key)
+        self._histograms["get_data"].observe(time.perf_counter() - start)
+        return data
+
+    async def _get_state_and_data(self, key):
+        start = time.perf_counter()
+        record = await self.storage.get_state_and_data(key)
+        self._histograms["get_state_and_data"].observe(time.perf_counter() - start)
+        return record
+
+    async def _set_state_and_data(self, key, state, data):
+        start = time.perf_counter()
+        await self.storage.set_state_and_data(key, state, data)
+        self._histograms["set_state_and_data"].observe(time.perf_counter() - start)
+
+    async def close(self):
+        await self.storage.close()
+
+
+def format_summary(registry=registry, limit=10):
+    """Короткая сводка для /perf: самые медленные обработчики и методы API по p95."""
+
+    def rows(name, label_names):
+        items = [
+            (histogram.quantile(0.95), labels, histogram)
+            for (metric, labels), histogram in registry.histograms.items()
+            if metric == name and histogram.count
+        ]
+        items.sort(key=lambda item: item[0], reverse=True)
+        result = []
+        for p95, labels, histogram in items[:limit]:
+            values = dict(labels)
+            title = " ".join(str(values[label]) for label in label_names if values.get(label))
+            result.append(
+                f"{title}: n={histogram.count} "
+                f"p50={histogram.quantile(0.5) * 1000:.1f} p95={p95 * 1000:.1f} мс"
+            )
+        return result or ["нет данных"]
+
+    lines = ["⏱ Обработчики:"]
+    lines += rows("bot_handler_seconds", ("handler", "state"))
+    lines += ["", "📡 Bot API:"]
+    lines += rows("bot_api_seconds", ("method",))
+    lines += ["", "💾 FSM:"]
+    lines += rows("fsm_storage_seconds", ("op",))
+    counters = [
+        f"{name}{_labels(labels)} = {value}" for (name, labels), value in sorted(registry.counters.items())
+    ]
+    if counters:
+        lines += ["", "⚠️ Счётчики:"] + counters
+    gauges = [f"{name} = {func()}" for name, func in sorted(registry.gauges.items())]
+    if gauges:
+        lines += [""] + gauges
+    return "\n".join(lines)
+
+
+async def start_metrics_server(registry=registry, host=METRICS_HOST, port=METRICS_PORT):
+    """Отдаёт /metrics в формате Prometheus; возвращает AppRunner для остановки."""
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики: http://%s:%s/metrics", host, port)
+    return runner
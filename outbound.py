@@ -0,0 +1,250 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+RATE_PER_MINUTE = 20  # лимит Telegram на сообщения в одну группу
+BURST = 5
+MAX_FORWARD_BATCH = 100  # больше forward_messages за раз не принимает
+MAX_BACKOFF = 60
+OUTBOUND_JOURNAL = "outbound.journal"
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (например, по RetryAfter от Telegram)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundQueue:
+    """
+    Фоновая очередь исходящих сообщений в служебные чаты.
+
+    Обработчик только ставит задание в очередь и сразу отвечает игроку.
+    Для каждого чата-получателя свой обработчик очереди и свой TokenBucket.
+    RetryAfter выдерживается, сетевые ошибки повторяются с нарастающей паузой,
+    поэтому задания не теряются. Подряд идущие пересылки из одного чата
+    склеиваются в один вызов forward_messages.
+
+    Если задан path, очередь дублируется в журнал: строка на каждое
+    поставленное задание и строка "в чате отправлено столько-то первых".
+    Не отправленное к остановке или падению load() после перезапуска
+    ставит в очередь заново, а пустая очередь обнуляет журнал.
+    """
+
+    def __init__(self, bot: Bot, rate_per_minute=RATE_PER_MINUTE, burst=BURST, path=None):
+        self.bot = bot
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.path = path
+        self._journal = None
+        self._queues = {}
+        self._wakeups = {}
+        self._buckets = {}
+        self._workers = {}
+
+    @property
+    def depth(self):
+        """Сколько заданий ждёт отправки во всех чатах."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def forward(self, chat_id, from_chat_id, message_id):
+        self._put(chat_id, ("forward", from_chat_id, message_id))
+
+    def forward_many(self, chat_id, from_chat_id, message_ids):
+        for message_id in message_ids:
+            self._put(chat_id, ("forward", from_chat_id, message_id))
+
+    def send_text(self, chat_id, text):
+        self._put(chat_id, ("text", text))
+
+    def load(self):
+        """Ставит в очередь задания, не отправленные до остановки; вызывается при запуске."""
+        if self.path is None:
+            return
+        pending = collections.defaultdict(collections.deque)
+        try:
+            with open(self.path, "rb") as journal:
+                for raw in journal:
+                    if not raw.endswith(b"\n"):
+                        # Недописанная строка после падения: задание не успели поставить
+                        break
+                    try:
+                        record = json.loads(raw)
+                    except ValueError:
+                        logger.warning("Повреждённая строка журнала %s: %r", self.path, raw)
+                        continue
+                    queue = pending[record["chat"]]
+                    if "job" in record:
+                        queue.append(tuple(record["job"]))
+                    else:
+                        for _ in range(min(record["done"], len(queue))):
+                            queue.popleft()
+        except FileNotFoundError:
+            pass
+        # Журнал пересобирается из одних неотправленных заданий
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as journal:
+            for chat_id, queue in pending.items():
+                for job in queue:
+                    journal.write(json.dumps({"chat": chat_id, "job": job}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self._journal = open(self.path, "a", encoding="utf-8")
+        restored = 0
+        for chat_id, queue in pending.items():
+            for job in queue:
+                self._enqueue(chat_id, job)
+                restored += 1
+        if restored:
+            logger.info("Из журнала %s восстановлено неотправленных заданий: %d", self.path, restored)
+
+    def _log(self, record):
+        if self._journal is None:
+            return
+        try:
+            self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._journal.flush()
+        except OSError as e:
+            logger.error("Не удалось записать журнал очереди %s: %s", self.path, e)
+
+    def _acknowledge(self, chat_id, count):
+        """Отмечает в журнале, что первые count заданий чата отправлены (или отброшены)."""
+        if self._journal is None:
+            return
+        if self.depth:
+            self._log({"chat": chat_id, "done": count})
+            return
+        # Всё отправлено — старые записи журнала больше не нужны
+        try:
+            self._journal.truncate(0)
+        except OSError as e:
+            logger.error("Не удалось очистить журнал очереди %s: %s", self.path, e)
+
+    def _put(self, chat_id, job):
+        self._log({"chat": chat_id, "job": job})
+        self._enqueue(chat_id, job)
+
+    def _enqueue(self, chat_id, job):
+        if chat_id not in self._queues:
+            self._queues[chat_id] = collections.deque()
+            self._wakeups[chat_id] = asyncio.Event()
+            self._buckets[chat_id] = TokenBucket(self.rate_per_minute / 60, self.burst)
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        self._queues[chat_id].append(job)
+        self._wakeups[chat_id].set()
+
+    def _take_batch(self, queue):
+        """Первое задание очереди вместе с идущими следом пересылками из того же чата."""
+        first = queue[0]
+        if first[0] != "forward":
+            return [first]
+        batch = [first]
+        for job in itertools.islice(queue, 1, MAX_FORWARD_BATCH):
+            if job[0] != "forward" or job[1] != first[1] or job[2] <= batch[-1][2]:
+                break
+            batch.append(job)
+        return batch
+
+    async def _send(self, chat_id, batch):
+        kind = batch[0][0]
+        if kind == "text":
+            await self.bot.send_message(chat_id, batch[0][1])
+        elif len(batch) == 1:
+            await self.bot.forward_message(chat_id, batch[0][1], batch[0][2])
+        else:
+            await self.bot.forward_messages(chat_id, batch[0][1], [job[2] for job in batch])
+
+    async def _worker(self, chat_id):
+        queue = self._queues[chat_id]
+        wakeup = self._wakeups[chat_id]
+        bucket = self._buckets[chat_id]
+        while True:
+            if not queue:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+
+            await bucket.acquire()
+            # Пока ждали токен, в очередь могли прийти ещё пересылки — склеиваем их
+            batch = self._take_batch(queue)
+            delay = 1
+            while True:
+                try:
+                    await self._send(chat_id, batch)
+                    break
+                except TelegramRetryAfter as e:
+                    logger.warning("RetryAfter %s с для чата %s", e.retry_after, chat_id)
+                    bucket.pause(e.retry_after)
+                    await bucket.acquire()
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    logger.warning("Ошибка отправки в чат %s, повтор через %s с: %s", chat_id, delay, e)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_BACKOFF)
+                except TelegramAPIError:
+                    # Повтор не поможет (сообщение удалено, бот исключён из чата и т.п.)
+                    logger.exception("Не удалось отправить в чат %s: %s", chat_id, batch)
+                    break
+                except Exception:
+                    logger.exception("Непредвиденная ошибка отправки в чат %s: %s", chat_id, batch)
+                    break
+            for _ in batch:
+                queue.popleft()
+            self._acknowledge(chat_id, len(batch))
+
+    async def drain(self, timeout=None):
+        """Ждёт, пока все очереди опустеют."""
+        async def wait_empty():
+            while self.depth:
+                await asyncio.sleep(0.05)
+
+        await asyncio.wait_for(wait_empty(), timeout)
+
+    async def close(self, timeout=10):
+        try:
+            await self.drain(timeout)
+        except asyncio.TimeoutError:
+            if self._journal is not None:
+                logger.warning("Не отправлено заданий при остановке: %d, отправим после перезапуска", self.depth)
+            else:
+                logger.error("Не отправлено заданий при остановке: %d", self.depth)
+        for worker in self._workers.values():
+            worker.cancel()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
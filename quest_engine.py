@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+
+from aiogram import F, Router, types
+from aiogram.filters import Filter
+from aiogram.fsm.context import FSMContext
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+QUESTS_DIR = "quests"
+DEFAULT_REMINDER = "⏰ Квест ждёт тебя! Ты остановился здесь:"
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_answer(text):
+    """Приводит ответ к виду для сравнения: без регистра, лишних пробелов и "ё"."""
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+# Функция для создания клавиатуры викторины
+def get_quiz_keyboard(options):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=opt, callback_data=opt)] for opt in options
+    ])
+
+
+class Step(ABC):
+    """
+    Скомпилированный шаг квеста: готовый текст, клавиатура и ссылка на следующий шаг.
+
+    Базовый класс; тип шага (AnswerStep, PhotoStep, TextStep) задаёт handle().
+    """
+
+    initial_data = {}
+
+    def __init__(self, quest, definition):
+        self.quest = quest
+        self.id = definition["id"]
+        self.state = f"{quest.id}:{self.id}"
+        self.prompt = definition["prompt"]
+        options = definition.get("options")
+        self.keyboard = get_quiz_keyboard(options) if options else None
+        self.next = None
+
+    async def enter(self, message: types.Message, state: FSMContext):
+        await message.answer(self.prompt, reply_markup=self.keyboard)
+        await state.set_state(self.state)
+        await state.update_data(self.initial_data, entered_at=time.time())
+
+    async def advance(self, message: types.Message, state: FSMContext, **fields):
+        """Переходит к следующему шагу; fields дописываются в событие завершения этапа."""
+        entered_at = (await state.get_data()).get("entered_at")
+        if entered_at is not None:
+            fields["dur"] = round(time.time() - entered_at, 1)
+        engine = self.quest.engine
+        engine.emit("stage", message, self, **fields)
+        if self.next is None:
+            engine.emit("done", message, self)
+            await state.clear()
+        else:
+            await self.next.enter(message, state)
+
+    async def remind(self, bot, chat_id):
+        """Напоминает игроку, который давно не отвечает, текущее задание."""
+        await bot.send_message(chat_id, f"{self.quest.reminder}\n\n{self.prompt}", reply_markup=self.keyboard)
+        analytics = self.quest.engine.analytics
+        if analytics is not None:
+            analytics.record("remind", self.quest.id, chat_id, self.id)
+
+    @abstractmethod
+    async def handle(self, message: types.Message, state: FSMContext, album=None):
+        """Обрабатывает сообщение игрока на этом шаге; album — все сообщения альбома, если их прислали пачкой."""
+
+
+class AnswerStep(Step):
+    """Текстовый ответ с ограниченным числом попыток."""
+
+    initial_data = {"attempts": 0}
+
+    def __init__(self, quest, definition):
+        super().__init__(quest, definition)
+        self.answers = frozenset(normalize_answer(answer) for answer in definition["answers"])
+        self.attempts = definition.get("attempts", 3)
+        self.correct = definition["correct"]
+        self.wrong = definition["wrong"]
+        self.failed = definition["failed"]
+        self.not_text = definition["not_text"]
+
+    async def handle(self, message: types.Message, state: FSMContext, album=None):
+        if message.text is None:
+            await message.answer(self.not_text)
+            return
+        await self.check(message, state, message.text)
+
+    async def check(self, message: types.Message, state: FSMContext, text):
+        data = await state.get_data()
+        attempts = data.get("attempts", 0) + 1
+        engine = self.quest.engine
+        if normalize_answer(text) in self.answers:
+            engine.emit("answer", message, self, ok=True, n=attempts)
+            await message.answer(self.correct)
+            await self.advance(message, state, ok=True, n=attempts)
+            return
+
+        engine.emit("answer", message, self, ok=False, n=attempts)
+        await state.update_data(attempts=attempts)
+        if attempts < self.attempts:
+            await message.answer(self.wrong.format(left=self.attempts - attempts))
+        else:
+            await message.answer(self.failed)
+            await self.advance(message, state, ok=False, n=attempts)
+
+
+class PhotoStep(Step):
+    """Задание на N фотографий, которые пересылаются в админский чат."""
+
+    initial_data = {"photo_count": 0}
+
+    def __init__(self, quest, definition):
+        super().__init__(quest, definition)
+        self.count = definition.get("count", 1)
+        self.progress = definition.get("progress")
+        self.done = definition["done"]
+        self.too_many = definition.get("too_many")
+        self.not_photo = definition["not_photo"]
+        self.admin_notice = definition["admin_notice"]
+
+    async def handle(self, message: types.Message, state: FSMContext, album=None):
+        # Альбом обрабатывается целиком: одна пересылка пачкой и один ответ
+        photos = [item for item in album or [message] if item.photo]
+        if not photos:
+            await message.answer(self.not_photo)
+            return
+
+        data = await state.get_data()
+        accepted = photos[:max(0, self.count - data.get("photo_count", 0))]
+        if not accepted:
+            if self.too_many:
+                await message.answer(self.too_many)
+            return
+
+        photo_count = data.get("photo_count", 0) + len(accepted)
+        await state.update_data(photo_count=photo_count)
+        engine = self.quest.engine
+        engine.emit("photo", message, self, n=len(accepted))
+        if engine.archiver is not None:
+            for item in accepted:
+                engine.archiver.submit(item, self.quest.id, self.id)
+        engine.outbound.forward_many(
+            engine.admin_chat_id, message.chat.id, [item.message_id for item in accepted]
+        )
+
+        if photo_count < self.count:
+            await message.answer(self.progress.format(count=photo_count, left=self.count - photo_count))
+            return
+
+        engine.outbound.send_text(
+            engine.admin_chat_id, self.admin_notice.format(username=message.from_user.username)
+        )
+        await message.answer(self.done)
+        await self.advance(message, state)
+
+
+class TextStep(Step):
+    """Свободный ответ: любое сообщение принимается."""
+
+    def __init__(self, quest, definition):
+        super().__init__(quest, definition)
+        self.reply = definition["reply"]
+
+    async def handle(self, message: types.Message, state: FSMContext, album=None):
+        await message.answer(self.reply)
+        await self.advance(message, state)
+
+
+STEP_TYPES = {
+    "answer": AnswerStep,
+    "photos": PhotoStep,
+    "text": TextStep,
+}
+
+
+class Quest:
+    def __init__(self, engine, definition):
+        self.engine = engine
+        self.id = definition["id"]
+        self.title = definition.get("title", self.id)
+        welcome = definition.get("welcome", {})
+        self.welcome_image = welcome.get("image")
+        self.welcome_caption = welcome.get("caption")
+        self.reminder = definition.get("reminder", DEFAULT_REMINDER)
+        self.legacy_state_group = definition.get("legacy_state_group")
+
+        self.steps = []
+        for step_definition in definition["steps"]:
+            try:
+                step_class = STEP_TYPES[step_definition["type"]]
+            except KeyError:
+                raise ValueError(
+                    f"Квест {self.id}: неизвестный тип шага {step_definition.get('type')!r}"
+                ) from None
+            self.steps.append(step_class(self, step_definition))
+        if not self.steps:
+            raise ValueError(f"Квест {self.id}: нет ни одного шага")
+        for step, next_step in zip(self.steps, self.steps[1:]):
+            step.next = next_step
+
+    @property
+    def first_step(self):
+        return self.steps[0]
+
+
+class StepFilter(Filter):
+    """Пропускает событие, если текущее состояние — шаг квеста, и передаёт этот шаг обработчику."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def __call__(self, event, raw_state=None):
+        step = self.engine.steps.get(raw_state)
+        if step is None:
+            return False
+        return {"step": step}
+
+
+class QuestEngine:
+    """
+    Квесты, описанные в JSON-файлах, скомпилированные в таблицу "состояние -> шаг".
+
+    Вместо отдельного обработчика на каждое состояние — один роутер,
+    который находит шаг по текущему состоянию за O(1).
+    """
+
+    def __init__(self, outbound, admin_chat_id, analytics=None, archiver=None):
+        self.outbound = outbound
+        self.admin_chat_id = admin_chat_id
+        self.analytics = analytics
+        self.archiver = archiver
+        self.quests = {}
+        self.steps = {}
+        self.default_quest = None
+        self.router = Router(name="quest")
+        self.router.message.register(self._on_message, StepFilter(self))
+        self.router.callback_query.register(self._on_callback, StepFilter(self), F.data)
+
+    def load_dir(self, path=QUESTS_DIR):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".json"):
+                self.load(os.path.join(path, name))
+
+    def load(self, path):
+        with open(path, "r", encoding="utf-8") as file:
+            quest = Quest(self, json.load(file))
+        if quest.id in self.quests:
+            raise ValueError(f"Квест {quest.id} загружен дважды ({path})")
+        self.quests[quest.id] = quest
+        for step in quest.steps:
+            self.steps[step.state] = step
+            if quest.legacy_state_group:
+                # Состояния, сохранённые до перехода на описания квестов
+                self.steps[f"{quest.legacy_state_group}:{step.id}"] = step
+        if self.default_quest is None:
+            self.default_quest = quest
+        logger.info("Загружен квест %s: %d шагов", quest.id, len(quest.steps))
+        return quest
+
+    def get_quest(self, quest_id=None):
+        if not quest_id:
+            return self.default_quest
+        return self.quests.get(quest_id)
+
+    def emit(self, event, message: types.Message, step, **fields):
+        """Пишет событие игрока на шаге step в журнал аналитики, если он подключён."""
+        if self.analytics is not None:
+            self.analytics.record(event, step.quest.id, message.chat.id, step.id, **fields)
+
+    async def start(self, message: types.Message, state: FSMContext, quest):
+        self.emit("start", message, quest.first_step)
+        await quest.first_step.enter(message, state)
+
+    async def _on_message(self, message: types.Message, state: FSMContext, step, album=None):
+        await step.handle(message, state, album)
+
+    async def _on_callback(self, callback: types.CallbackQuery, state: FSMContext, step):
+        await callback.answer()
+        if isinstance(step, AnswerStep):
+            await step.check(callback.message, state, callback.data)
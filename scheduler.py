@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.middlewares.user_context import EVENT_CONTEXT_KEY
+
+from metrics import registry
+
+MAX_CONCURRENT_UPDATES = 100  # одновременно обрабатываемых обновлений во всех чатах
+CHAT_QUEUE_SIZE = 20  # обновлений одного чата в очереди; остальные отбрасываются
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50)
+
+logger = logging.getLogger(__name__)
+registry.describe("scheduler_wait_seconds", "Ожидание обновления в очереди своего чата и общего лимита")
+registry.describe("scheduler_chat_queue_depth", "Сколько обновлений чата уже ждало при поступлении нового")
+registry.describe("scheduler_dropped_total", "Обновления, отброшенные из-за переполнения очереди чата")
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # asyncio.Lock будит ожидающих в порядке очереди
+        self.pending = 0
+
+
+class ChatScheduler(BaseMiddleware):
+    """
+    Порядок обработки обновлений: внутри чата строго по очереди, между чатами параллельно.
+
+    Обновления одного чата ждут друг друга, поэтому чтение-изменение-запись
+    данных FSM (счётчики фото и попыток) не гоняются между собой. Разные
+    чаты обрабатываются одновременно, но не больше concurrency сразу, чтобы
+    медленные запросы к API одного игрока не копили бесконечно задачи.
+    Очередь чата ограничена queue_size: лишние обновления (флуд)
+    отбрасываются с записью в лог и метрику.
+
+    Регистрируется внешней middleware обновлений раньше FSM: состояние
+    читается, когда подошла очередь обновления, а не при его поступлении.
+    """
+
+    def __init__(self, concurrency=MAX_CONCURRENT_UPDATES, queue_size=CHAT_QUEUE_SIZE, registry=registry):
+        self.queue_size = queue_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chats = {}
+        self._queued = 0
+        self._running = 0
+        self._wait = registry.histogram("scheduler_wait_seconds")
+        self._depth = registry.histogram("scheduler_chat_queue_depth", buckets=DEPTH_BUCKETS)
+        self._registry = registry
+        registry.gauge("scheduler_queued", lambda: self._queued)
+        registry.gauge("scheduler_running", lambda: self._running)
+
+    async def __call__(self, handler, event, data):
+        context = data.get(EVENT_CONTEXT_KEY)
+        chat_id = context and (context.chat_id or context.user_id)
+        if chat_id is None:
+            async with self._semaphore:
+                return await handler(event, data)
+
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = _ChatQueue()
+        if queue.pending >= self.queue_size:
+            self._registry.inc("scheduler_dropped_total")
+            logger.warning("Очередь чата %s переполнена, обновление %s отброшено", chat_id, event.update_id)
+            return None
+        self._depth.observe(queue.pending)
+        queue.pending += 1
+        self._queued += 1
+        started = time.perf_counter()
+        entered = False
+        try:
+            async with queue.lock, self._semaphore:
+                entered = True
+                self._queued -= 1
+                self._running += 1
+                self._wait.observe(time.perf_counter() - started)
+                try:
+                    return await handler(event, data)
+                finally:
+                    self._running -= 1
+        finally:
+            if not entered:
+                self._queued -= 1  # отменили, пока ждало очереди
+            queue.pending -= 1
+            if not queue.pending:
+                del self._chats[chat_id]
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import math
+import time
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.dispatcher.middlewares.user_context import EVENT_CONTEXT_KEY
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
+
+from metrics import registry
+from outbound import TokenBucket
+
+EVICT_AFTER = 30 * 60  # секунды без обновлений, после которых запись FSM выгружается из памяти
+REMIND_AFTER = 24 * 3600  # секунды без обновлений до напоминания (0 — не напоминать)
+REMINDER_RATE = 5  # напоминаний в секунду, чтобы не мешать ответам игрокам
+WHEEL_TICK = 5  # секунды на деление колеса таймеров
+WHEEL_SLOTS = 4096  # делений на оборот (~5,7 ч при WHEEL_TICK = 5)
+
+logger = logging.getLogger(__name__)
+registry.describe("sessions_evicted_total", "Записи FSM, выгруженные из памяти после простоя игрока")
+registry.describe("reminders_sent_total", "Напоминания игрокам, бросившим квест на середине")
+
+
+class TimerWheel:
+    """
+    Хэшированное колесо таймеров: по таймеру на ключ, O(1) на постановку и отмену.
+
+    Срок округляется до деления (tick секунд) и кладётся в ячейку
+    "деление по модулю slots"; ключи со сроком дальше одного оборота
+    лежат в той же ячейке и пропускаются, пока их оборот не наступит.
+    advance() проходит ячейки прошедших делений и возвращает истёкшие ключи.
+    """
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, clock=time.monotonic):
+        self.tick = tick
+        self._clock = clock
+        self._origin = clock()
+        self._current = 0  # последнее пройденное деление
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}  # ключ -> деление, на котором он истекает
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, delay):
+        """Ставит (или переставляет) таймер key на delay секунд от текущего момента."""
+        deadline = math.ceil((self._clock() + delay - self._origin) / self.tick)
+        # Пройденные деления уже не просматриваются
+        deadline = max(deadline, self._current + 1)
+        previous = self._deadlines.get(key)
+        if previous == deadline:
+            return
+        if previous is not None:
+            self._slots[previous % len(self._slots)].discard(key)
+        self._deadlines[key] = deadline
+        self._slots[deadline % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        deadline = self._deadlines.pop(key, None)
+        if deadline is not None:
+            self._slots[deadline % len(self._slots)].discard(key)
+
+    def advance(self):
+        """Истёкшие таймеры (они снимаются с колеса)."""
+        target = int((self._clock() - self._origin) // self.tick)
+        if target <= self._current:
+            return []
+        if target - self._current >= len(self._slots):
+            # Пропущен целый оборот (например, процесс стоял): смотрим все ячейки
+            slots = self._slots
+        else:
+            slots = [self._slots[tick % len(self._slots)] for tick in range(self._current + 1, target + 1)]
+        self._current = target
+        expired = []
+        for slot in slots:
+            due = [key for key in slot if self._deadlines[key] <= target]
+            for key in due:
+                slot.discard(key)
+                del self._deadlines[key]
+            expired.extend(due)
+        return expired
+
+
+class SessionTracker(BaseMiddleware):
+    """
+    Простой игроков: выгрузка их записей FSM из памяти и напоминание о квесте.
+
+    Каждое обновление из личного чата переставляет таймер чата на колесе
+    (TimerWheel), без отдельной задачи на игрока. Через evict_after секунд
+    простоя запись чата выгружается из памяти хранилища (в SQLite она
+    остаётся и читается при следующем сообщении). Если игрок бросил квест
+    на середине, через remind_after секунд простоя ему один раз
+    напоминается текущее задание, после чего чат снимается с колеса до
+    следующего обновления.
+
+    Колесо живёт в памяти, поэтому при запуске load() ставит напоминания
+    по времени последних изменений из базы: игрокам, чьё напоминание
+    пришлось на простой бота, оно придёт сразу, а тем, кто молчит больше
+    двух сроков, — уже нет.
+    """
+
+    def __init__(self, bot: Bot, storage, steps, evict_after=EVICT_AFTER, remind_after=REMIND_AFTER,
+                 blocked_users=None, rate=REMINDER_RATE, wheel=None, registry=registry):
+        self.bot = bot
+        self.storage = storage
+        self.steps = steps  # состояние -> шаг квеста (QuestEngine.steps)
+        self.evict_after = evict_after
+        self.remind_after = remind_after
+        self.blocked_users = blocked_users
+        self.rate = rate
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        self._evicted = set()  # чаты, чья запись уже выгружена и ждёт напоминания
+        self._reminders = asyncio.Queue()
+        self._registry = registry
+        registry.gauge("sessions_tracked", lambda: len(self.wheel))
+        registry.gauge("sessions_cached", lambda: self.storage.cached)
+
+    async def __call__(self, handler, event, data):
+        context = data.get(EVENT_CONTEXT_KEY)
+        if context is not None and context.chat is not None and context.chat.type == "private":
+            self.touch(context.chat.id)
+        return await handler(event, data)
+
+    def touch(self, chat_id):
+        """Отмечает активность чата: таймеры простоя идут заново."""
+        self._evicted.discard(chat_id)
+        self.wheel.schedule(chat_id, self.evict_after)
+
+    def _key(self, chat_id):
+        return StorageKey(bot_id=self.bot.id, chat_id=chat_id, user_id=chat_id)
+
+    async def _expire(self, chat_id):
+        key = self._key(chat_id)
+        if chat_id not in self._evicted:
+            if not self.storage.evict(key):
+                # Запись ещё пишется на диск — попробуем на следующем делении
+                self.wheel.schedule(chat_id, 0)
+                return
+            self._registry.inc("sessions_evicted_total")
+            if self.remind_after:
+                self._evicted.add(chat_id)
+                self.wheel.schedule(chat_id, max(0, self.remind_after - self.evict_after))
+            return
+
+        self._evicted.discard(chat_id)
+        step = self.steps.get(await self.storage.get_state(key))
+        # Чтение подняло запись в память; напоминание её не меняет
+        self.storage.evict(key)
+        if step is not None:
+            self._reminders.put_nowait((chat_id, step))
+
+    async def load(self):
+        """Ставит напоминания незавершённым квестам из базы (после перезапуска)."""
+        if not self.remind_after:
+            return
+        now = time.time()
+        sessions = await asyncio.to_thread(self.storage.idle_sessions, now - 2 * self.remind_after)
+        loaded = 0
+        for chat_id, state, updated_at in sessions:
+            if state in self.steps and chat_id not in self.wheel:
+                self._evicted.add(chat_id)
+                self.wheel.schedule(chat_id, max(0, updated_at + self.remind_after - now))
+                loaded += 1
+        logger.info("Незавершённых квестов для напоминаний: %d", loaded)
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for chat_id in self.wheel.advance():
+                try:
+                    await self._expire(chat_id)
+                except Exception:
+                    logger.exception("Ошибка таймера простоя чата %s", chat_id)
+
+    async def _send_reminders(self):
+        bucket = TokenBucket(self.rate, 1)
+        while True:
+            chat_id, step = await self._reminders.get()
+            await bucket.acquire()
+            # Игрок вернулся, пока напоминание ждало очереди, или заблокировал бота
+            if chat_id in self.wheel or (self.blocked_users is not None and chat_id in self.blocked_users):
+                continue
+            try:
+                await step.remind(self.bot, chat_id)
+            except TelegramRetryAfter as e:
+                bucket.pause(e.retry_after)
+                self._reminders.put_nowait((chat_id, step))
+                continue
+            except TelegramForbiddenError:
+                if self.blocked_users is not None:
+                    self.blocked_users.add(chat_id)
+            except TelegramAPIError as e:
+                logger.warning("Не удалось напомнить игроку %s: %s", chat_id, e)
+            else:
+                self._registry.inc("reminders_sent_total")
+            # Не напоминаем повторно и после перезапуска
+            await self.storage.mark_reminded(self._key(chat_id))
+
+    async def run(self):
+        """Загружает незавершённые квесты и обслуживает таймеры; запускается фоновой задачей."""
+        await self.load()
+        await asyncio.gather(self._tick(), self._send_reminders())
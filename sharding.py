@@ -0,0 +1,402 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+import zlib
+from contextlib import suppress
+
+from aiogram import Bot
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.methods import GetUpdates
+from aiohttp import web
+
+from fsm_storage import SQLiteStorage, read_idle_sessions
+from webhook import WEBHOOK_PATH, WEB_HOST, WEB_PORT, add_health_routes, serve
+
+SHARDS = 64  # число шардов фиксировано: при смене числа воркеров шарды переезжают целиком
+RING_REPLICAS = 100  # виртуальных узлов на воркер в кольце
+WORKER_MAX_IN_FLIGHT = 1000  # обновлений в работе у воркера; дальше он перестаёт читать stdin
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value):
+    return zlib.crc32(str(value).encode())
+
+
+def shard_for_chat(chat_id, shards=SHARDS):
+    return _hash(chat_id) % shards
+
+
+def update_chat_id(update):
+    """chat_id из "сырого" обновления (словаря), без разбора в объекты aiogram."""
+    for key, event in update.items():
+        if not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if "from" in event:
+            return event["from"]["id"]
+    return 0
+
+
+def update_user_id(update):
+    """id отправителя из "сырого" обновления или None."""
+    for key, event in update.items():
+        if isinstance(event, dict) and "from" in event:
+            return event["from"]["id"]
+    return None
+
+
+class HashRing:
+    """
+    Консистентное хэширование шардов по воркерам.
+
+    При изменении числа воркеров переезжает примерно 1/N шардов,
+    остальные остаются у прежних владельцев.
+    """
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        self.workers = workers
+        self._ring = sorted(
+            (_hash(f"worker-{worker}-{replica}"), worker)
+            for worker in range(workers)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    def worker_for_shard(self, shard):
+        index = bisect.bisect(self._points, _hash(f"shard-{shard}")) % len(self._ring)
+        return self._ring[index][1]
+
+    def worker_for_chat(self, chat_id, shards=SHARDS):
+        return self.worker_for_shard(shard_for_chat(chat_id, shards))
+
+    def shards_of(self, worker, shards=SHARDS):
+        return [shard for shard in range(shards) if self.worker_for_shard(shard) == worker]
+
+
+def shard_path(path, shard):
+    root, ext = os.path.splitext(path)
+    return f"{root}-{shard:03d}{ext}"
+
+
+class ShardedStorage(BaseStorage):
+    """
+    FSM-хранилище воркера: отдельный SQLite-файл на каждый шард.
+
+    Воркер открывает только файлы шардов, чьи чаты к нему приходят,
+    поэтому у каждого файла ровно один владелец и блокировки между
+    процессами не нужны. owned — шарды этого воркера: из них после
+    перезапуска берутся незавершённые сессии (idle_sessions).
+    """
+
+    def __init__(self, path, shards=SHARDS, owned=()):
+        self.path = path
+        self.shards = shards
+        self.owned = owned
+        self._storages = {}
+
+    def _storage(self, key: StorageKey):
+        shard = shard_for_chat(key.chat_id, self.shards)
+        storage = self._storages.get(shard)
+        if storage is None:
+            storage = self._storages[shard] = SQLiteStorage(shard_path(self.path, shard))
+        return storage
+
+    async def set_state(self, key, state=None):
+        await self._storage(key).set_state(key, state)
+
+    async def get_state(self, key):
+        return await self._storage(key).get_state(key)
+
+    async def set_data(self, key, data):
+        await self._storage(key).set_data(key, data)
+
+    async def get_data(self, key):
+        return await self._storage(key).get_data(key)
+
+    async def get_state_and_data(self, key):
+        return await self._storage(key).get_state_and_data(key)
+
+    async def set_state_and_data(self, key, state, data):
+        await self._storage(key).set_state_and_data(key, state, data)
+
+    def evict(self, key):
+        return self._storage(key).evict(key)
+
+    @property
+    def cached(self):
+        return sum(storage.cached for storage in self._storages.values())
+
+    async def mark_reminded(self, key):
+        await self._storage(key).mark_reminded(key)
+
+    def idle_sessions(self, since):
+        sessions = []
+        for shard in self.owned:
+            path = shard_path(self.path, shard)
+            if os.path.exists(path):
+                sessions.extend(read_idle_sessions(path, since))
+        return sessions
+
+    async def flush(self):
+        for storage in self._storages.values():
+            await storage.flush()
+
+    async def close(self):
+        for storage in self._storages.values():
+            await storage.close()
+
+
+def worker_main():
+    """
+    Точка входа процесса-воркера: python sharding.py.
+
+    Номер воркера и режим списка оплативших приходят через переменные
+    окружения (их читает bot.py при импорте), обновления — построчно в stdin.
+    """
+    # Останавливает воркеров фронт-процесс, закрывая stdin после последнего обновления
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Оповещение об изменении списка оплативших может прийти, пока бот ещё импортируется
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    import bot as app
+
+    asyncio.run(_worker_loop(app))
+
+
+async def _worker_loop(app):
+    from aiogram.types import Update
+
+    from database import store
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2 ** 24)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    await app.dp.emit_startup(bot=app.bot, dispatcher=app.dp, **app.dp.workflow_data)
+    if app.PAID_USERS_WRITER:
+        # Фронт разошлёт остальным воркерам SIGUSR1, и они перечитают журнал сразу
+        store.subscribe(lambda: os.kill(os.getppid(), signal.SIGUSR1))
+    in_flight = asyncio.Semaphore(WORKER_MAX_IN_FLIGHT)
+    tasks = set()
+
+    async def handle(update):
+        try:
+            await app.dp.feed_update(app.bot, update)
+        except Exception:
+            logger.exception("Ошибка обработки обновления %s", update.update_id)
+        finally:
+            in_flight.release()
+
+    try:
+        while line := await reader.readline():
+            update = Update.model_validate(json.loads(line), context={"bot": app.bot})
+            # Порядок внутри чата держит ChatScheduler, разные чаты идут параллельно.
+            # Когда задач слишком много, воркер не читает stdin и фронт ждёт на drain()
+            await in_flight.acquire()
+            task = asyncio.create_task(handle(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        await app.dp.emit_shutdown(bot=app.bot, dispatcher=app.dp, **app.dp.workflow_data)
+        await app.bot.session.close()
+
+
+class WorkerPool:
+    """
+    Процессы-воркеры и маршрутизация обновлений к ним по chat_id.
+
+    Исключение — обновления от админа из любого чата (личного, админской
+    группы): они всегда идут воркеру, который пишет список оплативших,
+    иначе /add и /remove из группы попали бы к воркеру только для чтения.
+    FSM-записи админа в чужих шардах трогает только этот воркер, а SQLite
+    сам разводит запись двух процессов в один файл.
+    """
+
+    def __init__(self, workers, admin_id, shards=SHARDS, replicas=RING_REPLICAS):
+        self.shards = shards
+        self.ring = HashRing(workers, replicas)
+        self.admin_id = admin_id
+        # Список оплативших меняет только воркер, которому достаются команды админа
+        self.paid_users_writer = self.ring.worker_for_chat(admin_id, shards)
+        self.processes = [None] * workers
+        self._stopping = False
+
+    async def _spawn(self, index):
+        env = dict(os.environ, WORKER_INDEX=str(index), SHARDS=str(self.shards))
+        if index != self.paid_users_writer:
+            env["PAID_USERS_READ_ONLY"] = "1"
+        self.processes[index] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), stdin=asyncio.subprocess.PIPE, env=env,
+        )
+
+    async def start(self):
+        for index in range(len(self.processes)):
+            await self._spawn(index)
+        logger.info(
+            "Запущено воркеров: %d, шардов: %d, список оплативших пишет воркер %d",
+            len(self.processes), self.shards, self.paid_users_writer,
+        )
+
+    async def route(self, update):
+        """Отправляет "сырое" обновление воркеру, владеющему шардом его чата."""
+        if update_user_id(update) == self.admin_id:
+            index = self.paid_users_writer
+        else:
+            index = self.ring.worker_for_chat(update_chat_id(update), self.shards)
+        line = json.dumps(update).encode() + b"\n"
+        for _ in range(2):
+            process = self.processes[index]
+            if process.returncode is not None:
+                await self._spawn(index)
+                process = self.processes[index]
+            try:
+                process.stdin.write(line)
+                # Если воркер не успевает, фронт ждёт его, а не копит обновления в памяти
+                await process.stdin.drain()
+                return
+            except ConnectionError:
+                logger.error("Воркер %d недоступен, перезапуск", index)
+                await process.wait()
+        logger.error("Обновление %s не доставлено воркеру %d", update.get("update_id"), index)
+
+    def invalidate_paid_users(self):
+        """Рассылает читающим воркерам сигнал, что список оплативших изменился."""
+        for index, process in enumerate(self.processes):
+            if index != self.paid_users_writer and process is not None and process.returncode is None:
+                with suppress(ProcessLookupError):
+                    process.send_signal(signal.SIGUSR1)
+
+    async def watch(self):
+        """Перезапускает упавшие воркеры."""
+        while not self._stopping:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self.processes):
+                if process.returncode is not None and not self._stopping:
+                    logger.error("Воркер %d завершился с кодом %s, перезапуск", index, process.returncode)
+                    await self._spawn(index)
+
+    async def stop(self, timeout=30):
+        """Закрывает воркерам stdin и ждёт, пока они дообработают свои очереди."""
+        self._stopping = True
+        for process in self.processes:
+            if process.returncode is None:
+                process.stdin.close()
+        for process in self.processes:
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+
+
+async def run_polling_front(bot: Bot, pool: WorkerPool, allowed_updates=None, polling_timeout=10,
+                            checkpoint=None):
+    """
+    Фронт-процесс: забирает обновления long polling'ом и раздаёт их воркерам.
+
+    С checkpoint опрос продолжается с сохранённой отметки, а отметка
+    сдвигается, когда обновление передано воркеру. При остановке
+    воркеры дообрабатывают всё переданное, и только потом отметка
+    сохраняется окончательно.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    with suppress(NotImplementedError):
+        loop.add_signal_handler(signal.SIGUSR1, pool.invalidate_paid_users)
+
+    get_updates = GetUpdates(timeout=polling_timeout, allowed_updates=allowed_updates)
+    request_timeout = int(bot.session.timeout + polling_timeout)
+    await pool.start()
+    watcher = asyncio.create_task(pool.watch())
+    saver = None
+    if checkpoint is not None:
+        get_updates.offset = checkpoint.offset
+        saver = asyncio.create_task(checkpoint.run())
+        checkpoint.ready()
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            fetch = asyncio.create_task(bot(get_updates, request_timeout=request_timeout))
+            await asyncio.wait([fetch, stopping], return_when=asyncio.FIRST_COMPLETED)
+            if not fetch.done():
+                fetch.cancel()
+                break
+            try:
+                updates = fetch.result()
+            except Exception as e:
+                logger.error("Не удалось получить обновления: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await _route(pool, checkpoint, update.model_dump(mode="json", exclude_unset=True, by_alias=True))
+                get_updates.offset = update.update_id + 1
+    finally:
+        stopping.cancel()
+        watcher.cancel()
+        await pool.stop()
+        if checkpoint is not None:
+            saver.cancel()
+            await checkpoint.save()
+        await bot.session.close()
+
+
+async def _route(pool, checkpoint, update):
+    if checkpoint is None:
+        await pool.route(update)
+        return
+    update_id = update["update_id"]
+    if not checkpoint.begin(update_id):
+        return
+    try:
+        await pool.route(update)
+    finally:
+        checkpoint.end(update_id)
+
+
+async def run_webhook_front(bot: Bot, pool: WorkerPool, url, path=WEBHOOK_PATH, secret=None,
+                            host=WEB_HOST, port=WEB_PORT, allowed_updates=None, checkpoint=None):
+    """Фронт-процесс в режиме webhook: проверяет секрет и раздаёт обновления воркерам без разбора."""
+
+    async def handle(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if secret and not secrets.compare_digest(token, secret):
+            return web.Response(body="Unauthorized", status=401)
+        await _route(pool, checkpoint, await request.json())
+        return web.json_response({})
+
+    app = web.Application()
+    add_health_routes(app)
+    app.router.add_post(path, handle)
+    with suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, pool.invalidate_paid_users)
+    await pool.start()
+    watcher = asyncio.create_task(pool.watch())
+    saver = None
+    if checkpoint is not None:
+        saver = asyncio.create_task(checkpoint.run())
+        checkpoint.ready()
+    try:
+        await serve(app, bot, url, secret, host, port, allowed_updates=allowed_updates)
+    finally:
+        watcher.cancel()
+        await pool.stop()
+        if saver is not None:
+            saver.cancel()
+            await checkpoint.save()
+
+
+if __name__ == "__main__":
+    worker_main()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+WEBHOOK_PATH = "/webhook"
+WEB_HOST = "0.0.0.0"
+WEB_PORT = 8080
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(dp: Dispatcher, bot: Bot, path=WEBHOOK_PATH, secret=None):
+    """
+    aiohttp-приложение для приёма обновлений от Telegram.
+
+    Секретный токен из заголовка X-Telegram-Bot-Api-Secret-Token проверяется,
+    на запрос сразу отвечаем 200, а обновление обрабатывается в фоне.
+    /healthz — процесс жив, /readyz — webhook зарегистрирован и бот готов.
+    """
+    app = web.Application()
+    add_health_routes(app)
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=True
+    ).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def add_health_routes(app):
+    app["ready"] = False
+
+    async def healthz(request):
+        return web.json_response({"status": "ok"})
+
+    async def readyz(request):
+        if not request.app["ready"]:
+            return web.json_response({"status": "starting"}, status=503)
+        return web.json_response({"status": "ready"})
+
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+
+
+async def serve(app, bot: Bot, url, secret=None, host=WEB_HOST, port=WEB_PORT,
+                allowed_updates=None, drop_pending_updates=False):
+    """Поднимает HTTP-сервер, регистрирует webhook и работает до SIGTERM/SIGINT."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await bot.set_webhook(
+            url,
+            secret_token=secret,
+            drop_pending_updates=drop_pending_updates,
+            allowed_updates=allowed_updates,
+        )
+        app["ready"] = True
+        logger.info("Webhook %s, слушаем %s:%s", url, host, port)
+        await stop.wait()
+    finally:
+        app["ready"] = False
+        await runner.cleanup()
+        await bot.session.close()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, url, path=WEBHOOK_PATH, secret=None,
+                      host=WEB_HOST, port=WEB_PORT, drop_pending_updates=False):
+    app = create_app(dp, bot, path, secret)
+    await serve(
+        app, bot, url, secret, host, port,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=drop_pending_updates,
+    )